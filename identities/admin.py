@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import Identity, OptIn, OptOut
+from .models import HookDeadLetter, Identity, OptIn, OptOut
+from .tasks import DeliverHook
 
 
 class IdentityAdmin(admin.ModelAdmin):
@@ -39,6 +40,31 @@ class OptInAdmin(admin.ModelAdmin):
     raw_id_fields = ["identity", "created_by"]
 
 
+class HookDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ["id", "target", "hook", "instance_id", "attempts", "created_at"]
+    list_filter = ["target", "created_at"]
+    search_fields = ["instance_id"]
+    raw_id_fields = ["hook"]
+    actions = ["redeliver"]
+
+    def redeliver(self, request, queryset):
+        for dead_letter in queryset:
+            DeliverHook.apply_async(
+                kwargs={
+                    "target": dead_letter.target,
+                    "payload": dead_letter.payload,
+                    "instance_id": dead_letter.instance_id,
+                    "hook_id": dead_letter.hook_id,
+                }
+            )
+        count = len(queryset)
+        queryset.delete()
+        self.message_user(request, "Queued %s deliveries." % count)
+
+    redeliver.short_description = "Redeliver selected hooks"
+
+
 admin.site.register(Identity, IdentityAdmin)
 admin.site.register(OptOut, OptOutAdmin)
 admin.site.register(OptIn, OptInAdmin)
+admin.site.register(HookDeadLetter, HookDeadLetterAdmin)
@@ -0,0 +1,83 @@
+import base64
+import timeit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.authentication import BasicAuthentication, TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from seed_identity_store.auth import (
+    CachedBasicAuthentication,
+    CachedTokenAuthentication,
+    invalidate_cached_credentials,
+    invalidate_cached_token,
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the time taken to authenticate a request with each of the "
+        "authentication classes, after a first request to warm any caches. A "
+        "temporary user is created, and removed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=100,
+            help="The number of requests to authenticate with each class",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                user, token = self.benchmark(options["requests"])
+                raise Rollback()
+        except Rollback:
+            pass
+        invalidate_cached_credentials(user.get_username())
+        invalidate_cached_token(token.key)
+
+    def benchmark(self, requests):
+        user = User.objects.create_user("benchmark_auth", password="benchmark")
+        token = Token.objects.create(user=user)
+        basic = "Basic {}".format(
+            base64.b64encode(b"benchmark_auth:benchmark").decode("ascii")
+        )
+        factory = APIRequestFactory()
+
+        for authentication, header in [
+            (BasicAuthentication, basic),
+            (CachedBasicAuthentication, basic),
+            (TokenAuthentication, "Token {}".format(token.key)),
+            (CachedTokenAuthentication, "Token {}".format(token.key)),
+        ]:
+            request = Request(
+                factory.get("/", HTTP_AUTHORIZATION=header),
+                authenticators=[authentication()],
+            )
+
+            def authenticate():
+                # Authenticates again, as for a new request
+                request._authenticate()
+                if request.user != user:
+                    raise CommandError(
+                        "{} failed to authenticate".format(authentication.__name__)
+                    )
+
+            authenticate()
+            seconds = timeit.timeit(authenticate, number=requests)
+            self.stdout.write(
+                "{}: {:.3f} ms per request".format(
+                    authentication.__name__, seconds * 1000 / requests
+                )
+            )
+        return user, token
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import aiohttp
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from identities.models import OutboxEvent
+from identities.tasks import (
+    HOOK_REQUESTS,
+    circuit_allows,
+    circuit_open_countdown,
+    dead_letter,
+    hook_headers,
+    is_retryable_status,
+    record_target_failure,
+    record_target_success,
+    retry_delivery,
+)
+from seed_identity_store.metrics import start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """
+    Claims deliveries from the outbox, and delivers them concurrently. The
+    database is only used from a single thread, so that the event loop isn't
+    blocked on it, and the circuit breaker's cache calls are made from other
+    threads. Deliveries that fail are handed to the DeliverHook task to be
+    retried.
+
+    Claimed deliveries are leased to this dispatcher for
+    HOOK_DISPATCHER_LEASE_TIMEOUT seconds, and are only removed from the
+    outbox once they have been delivered or handed off, so that if this
+    dispatcher stops they are claimed again once the lease expires.
+    """
+
+    def __init__(self, concurrency, target_concurrency, poll_interval):
+        self.name = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.target_limits = defaultdict(lambda: asyncio.Semaphore(target_concurrency))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.in_flight = set()
+        # The number of deliveries in flight that are waiting for a slot for
+        # their target, which don't count towards the concurrency
+        self.waiting = 0
+        # The ids of the events that are done with, to be removed from the
+        # outbox
+        self.done = []
+        self.stopping = False
+
+    def stop(self):
+        self.stopping = True
+
+    def remove(self, event_ids):
+        # Events that another dispatcher has claimed since their lease expired
+        # are left for it to remove
+        if event_ids:
+            OutboxEvent.objects.filter(id__in=event_ids, claimed_by=self.name).delete()
+
+    def claim(self, limit, full_targets, done):
+        """
+        Removes the events in done from the outbox, and leases up to limit
+        more to this dispatcher.
+        """
+        with transaction.atomic():
+            self.remove(done)
+            events = list(
+                OutboxEvent.objects.unclaimed()
+                .select_for_update(skip_locked=True)
+                .filter(batched=False)
+                .exclude(target__in=full_targets)
+                .order_by("id")[:limit]
+            )
+            OutboxEvent.objects.filter(id__in=[e.id for e in events]).update(
+                claimed_at=timezone.now(), claimed_by=self.name
+            )
+        return events
+
+    def in_executor(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    def in_thread(self, func, *args):
+        # For blocking calls that don't use the database
+        return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def run(self, once=False):
+        """
+        Delivers from the outbox until stopped, or, if once is set, until the
+        outbox is empty.
+        """
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=settings.HOOK_CONNECT_TIMEOUT,
+            sock_read=settings.HOOK_READ_TIMEOUT,
+        )
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        try:
+            async with aiohttp.ClientSession(
+                connector=connector, timeout=timeout
+            ) as session:
+                await self.dispatch(session, once)
+        finally:
+            await self.in_executor(connections.close_all)
+            self.executor.shutdown()
+
+    async def dispatch(self, session, once):
+        while not self.stopping:
+            free = self.concurrency - (len(self.in_flight) - self.waiting)
+            if free <= 0:
+                await asyncio.wait(self.in_flight, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            # Deliveries for targets without a free slot are left in the
+            # outbox, so that a slow target doesn't hold up the others
+            full_targets = [
+                target
+                for target, target_limit in self.target_limits.items()
+                if target_limit.locked()
+            ]
+            limit = min(free, settings.HOOK_BATCH_SIZE)
+            done, self.done = self.done, []
+            events = await self.in_executor(self.claim, limit, full_targets, done)
+            for event in events:
+                task = asyncio.ensure_future(self.deliver(session, event))
+                self.in_flight.add(task)
+                task.add_done_callback(self.in_flight.discard)
+            # Lets the new deliveries start, so that those waiting for their
+            # target are counted as waiting
+            await asyncio.sleep(0)
+            if len(events) == limit:
+                # There may be more waiting
+                continue
+
+            if not once:
+                await asyncio.sleep(self.poll_interval)
+            elif self.in_flight:
+                await asyncio.wait(self.in_flight, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                break
+
+        if self.in_flight:
+            await asyncio.wait(self.in_flight)
+        await self.in_executor(self.remove, self.done)
+
+    async def deliver(self, session, event):
+        delivery = event.delivery()
+        target_limit = self.target_limits[delivery["target"]]
+        self.waiting += 1
+        try:
+            await target_limit.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            handoff = await self.post(session, delivery)
+        finally:
+            target_limit.release()
+
+        if handoff is not None:
+            try:
+                await self.in_executor(*handoff)
+            except Exception:
+                # Left in the outbox, to be claimed again once the lease expires
+                logger.exception("Failed to hand off delivery %s", event.id)
+                return
+        self.done.append(event.id)
+
+    async def post(self, session, delivery):
+        """
+        Delivers to the target. Returns None if it was delivered, otherwise
+        the function and arguments to hand the delivery off with.
+        """
+        target = delivery["target"]
+        if not await self.in_thread(circuit_allows, target):
+            return (
+                retry_delivery,
+                delivery,
+                0,
+                "Circuit open for target",
+                circuit_open_countdown(0),
+            )
+
+        HOOK_REQUESTS.labels(urlparse(target).hostname).inc()
+        try:
+            async with session.post(
+                target, data=json.dumps(delivery["payload"]), headers=hook_headers()
+            ) as response:
+                await response.read()
+                response.raise_for_status()
+        except aiohttp.ClientResponseError as e:
+            error, retryable = str(e), is_retryable_status(e.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error, retryable = str(e) or e.__class__.__name__, True
+        else:
+            await self.in_thread(record_target_success, target)
+            return None
+
+        if retryable:
+            await self.in_thread(record_target_failure, target)
+            return (retry_delivery, delivery, 0, error)
+        # The target is up, it just didn't accept this delivery
+        await self.in_thread(record_target_success, target)
+        return (dead_letter, delivery, 1, error)
+
+
+class Command(BaseCommand):
+    help = (
+        "Delivers the webhooks in the outbox from a single process, with many "
+        "deliveries in flight at once. Requires HOOK_OUTBOX to be enabled."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Deliver what is in the outbox, and then exit",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.HOOK_OUTBOX:
+            raise CommandError("HOOK_OUTBOX must be enabled to dispatch hooks")
+
+        start_metrics_server()
+        dispatcher = Dispatcher(
+            concurrency=settings.HOOK_DISPATCHER_CONCURRENCY,
+            target_concurrency=settings.HOOK_DISPATCHER_TARGET_CONCURRENCY,
+            poll_interval=settings.HOOK_OUTBOX_DISPATCH_INTERVAL,
+        )
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, dispatcher.stop)
+        try:
+            loop.run_until_complete(dispatcher.run(once=options["once"]))
+        finally:
+            loop.close()
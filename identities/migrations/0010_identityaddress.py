@@ -0,0 +1,63 @@
+# Generated by Django 2.2.8 on 2026-10-18 17:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BACKFILL_ADDRESSES = """
+INSERT INTO identities_identityaddress
+    (identity_id, address_type, address, optedout, inactive, "default")
+SELECT
+    i.id,
+    t.key,
+    a.key,
+    COALESCE(a.value ->> 'optedout' IN ('true', 'True'), false),
+    COALESCE(a.value ->> 'inactive' IN ('true', 'True'), false),
+    COALESCE(a.value ->> 'default' IN ('true', 'True'), false)
+FROM identities_identity i,
+    jsonb_each(CASE WHEN jsonb_typeof(i.details -> 'addresses') = 'object'
+        THEN i.details -> 'addresses' ELSE '{}' END) t,
+    jsonb_each(CASE WHEN jsonb_typeof(t.value) = 'object'
+        THEN t.value ELSE '{}' END) a
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("identities", "0009_auto_20190201_1506")]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdentityAddress",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "address_type",
+                    models.CharField(
+                        help_text="Address type, e.g. msisdn or email.", max_length=50
+                    ),
+                ),
+                ("address", models.TextField(help_text="The address value.")),
+                ("optedout", models.BooleanField(default=False)),
+                ("inactive", models.BooleanField(default=False)),
+                ("default", models.BooleanField(default=False)),
+                (
+                    "identity",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="addresses",
+                        to="identities.Identity",
+                    ),
+                ),
+            ],
+            options={"unique_together": {("address_type", "address", "identity")}},
+        ),
+        migrations.RunSQL(BACKFILL_ADDRESSES, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.8 on 2026-10-18 17:55
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    # The index is built concurrently so that identities can still be written
+    # to while it is being created, which can't happen inside a transaction.
+    atomic = False
+
+    dependencies = [("identities", "0010_identityaddress")]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS identities_details_gin_idx "
+            "ON identities_identity USING gin (details jsonb_path_ops)",
+            "DROP INDEX CONCURRENTLY IF EXISTS identities_details_gin_idx",
+            state_operations=[
+                migrations.AddIndex(
+                    model_name="identity",
+                    index=django.contrib.postgres.indexes.GinIndex(
+                        fields=["details"],
+                        name="identities_details_gin_idx",
+                        opclasses=["jsonb_path_ops"],
+                    ),
+                )
+            ],
+        )
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 2.2.8 on 2026-10-18 19:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+COPY_COUNTS = """
+INSERT INTO identities_failedmessagecount (identity_id, count, notified)
+SELECT id, failed_message_count, false
+FROM identities_identity
+WHERE failed_message_count <> 0
+"""
+
+RESTORE_COUNTS = """
+UPDATE identities_identity AS i SET failed_message_count = c.count
+FROM identities_failedmessagecount AS c
+WHERE c.identity_id = i.id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("identities", "0011_identity_details_gin")]
+
+    operations = [
+        migrations.CreateModel(
+            name="FailedMessageCount",
+            fields=[
+                (
+                    "identity",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="failed_message_counter",
+                        serialize=False,
+                        to="identities.Identity",
+                    ),
+                ),
+                (
+                    "count",
+                    models.IntegerField(
+                        default=0,
+                        help_text="Count of consecutive failed messages to user",
+                    ),
+                ),
+                (
+                    "last_failure_at",
+                    models.DateTimeField(
+                        blank=True,
+                        help_text="Time of the last failed message.",
+                        null=True,
+                    ),
+                ),
+                (
+                    "notified",
+                    models.BooleanField(
+                        default=False,
+                        help_text="Whether the identity.max_failures hook has "
+                        "been fired for the current count.",
+                    ),
+                ),
+            ],
+        ),
+        # Leave free space in each page, so that updates to the count can be
+        # written to the same page without touching the primary key index.
+        migrations.RunSQL(
+            "ALTER TABLE identities_failedmessagecount SET (fillfactor = 50)",
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(COPY_COUNTS, RESTORE_COUNTS),
+        migrations.RemoveField(model_name="identity", name="failed_message_count"),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 2.2.8 on 2026-10-18 18:22
+
+import django.contrib.postgres.fields.jsonb
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rest_hooks", "0001_initial"),
+        ("identities", "0012_failedmessagecount"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HookDeadLetter",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "target",
+                    models.URLField(help_text="The target URL.", max_length=255),
+                ),
+                (
+                    "payload",
+                    django.contrib.postgres.fields.jsonb.JSONField(
+                        help_text="The payload that was to be delivered."
+                    ),
+                ),
+                (
+                    "instance_id",
+                    models.CharField(
+                        blank=True,
+                        help_text="The ID of the instance that triggered the hook.",
+                        max_length=255,
+                        null=True,
+                    ),
+                ),
+                (
+                    "attempts",
+                    models.IntegerField(
+                        help_text="The number of delivery attempts made."
+                    ),
+                ),
+                (
+                    "error",
+                    models.TextField(help_text="The error from the last attempt."),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "hook",
+                    models.ForeignKey(
+                        help_text="The hook that the delivery was for.",
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="rest_hooks.Hook",
+                    ),
+                ),
+            ],
+        )
+    ]
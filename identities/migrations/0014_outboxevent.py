@@ -0,0 +1,50 @@
+# Generated by Django 2.2.8 on 2026-10-18 18:24
+
+import django.contrib.postgres.fields.jsonb
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rest_hooks", "0001_initial"),
+        ("identities", "0013_hookdeadletter"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxEvent",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "target",
+                    models.URLField(help_text="The target URL.", max_length=255),
+                ),
+                (
+                    "payload",
+                    django.contrib.postgres.fields.jsonb.JSONField(
+                        help_text="The payload to deliver."
+                    ),
+                ),
+                (
+                    "instance_id",
+                    models.CharField(
+                        blank=True,
+                        help_text="The ID of the instance that triggered the hook.",
+                        max_length=255,
+                        null=True,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "hook",
+                    models.ForeignKey(
+                        help_text="The hook that fired.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="rest_hooks.Hook",
+                    ),
+                ),
+            ],
+        )
+    ]
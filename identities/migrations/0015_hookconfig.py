@@ -0,0 +1,50 @@
+# Generated by Django 2.2.8 on 2026-10-18 18:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("rest_hooks", "0001_initial"), ("identities", "0014_outboxevent")]
+
+    operations = [
+        migrations.CreateModel(
+            name="HookConfig",
+            fields=[
+                (
+                    "hook",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="config",
+                        serialize=False,
+                        to="rest_hooks.Hook",
+                    ),
+                ),
+                (
+                    "batch_size",
+                    models.PositiveIntegerField(
+                        blank=True,
+                        help_text="If set, deliveries are posted together as a JSON array of up to this many payloads.",
+                        null=True,
+                    ),
+                ),
+                (
+                    "batch_window",
+                    models.PositiveIntegerField(
+                        default=5,
+                        help_text="The maximum number of seconds to wait for a batch to fill before posting it.",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="outboxevent",
+            name="batched",
+            field=models.BooleanField(
+                default=False,
+                help_text="Whether this is to be delivered in a batch by deliver_hook_batch, instead of by itself.",
+            ),
+        ),
+    ]
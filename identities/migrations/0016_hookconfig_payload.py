@@ -0,0 +1,35 @@
+# Generated by Django 2.2.8 on 2026-10-18 18:33
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("identities", "0015_hookconfig")]
+
+    operations = [
+        migrations.AddField(
+            model_name="hookconfig",
+            name="payload_fields",
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                blank=True,
+                default=list,
+                help_text="The fields of the event data to deliver, for the fields payload mode. Nested fields can be given as dotted paths, e.g. details.name",
+            ),
+        ),
+        migrations.AddField(
+            model_name="hookconfig",
+            name="payload_mode",
+            field=models.CharField(
+                choices=[
+                    ("full", "The full payload"),
+                    ("id", "Only the identity's ID"),
+                    ("fields", "Only the fields in payload_fields"),
+                ],
+                default="full",
+                help_text="Which parts of the event data are delivered.",
+                max_length=6,
+            ),
+        ),
+    ]
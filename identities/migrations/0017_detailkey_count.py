@@ -0,0 +1,19 @@
+# Generated by Django 2.2.8 on 2026-10-18 18:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("identities", "0016_hookconfig_payload")]
+
+    operations = [
+        migrations.AddField(
+            model_name="detailkey",
+            name="count",
+            field=models.IntegerField(
+                default=1,
+                help_text="The number of identities with this key, as of the last reconciliation.",
+            ),
+        )
+    ]
@@ -0,0 +1,12 @@
+# Generated by Django 2.2.8 on 2026-10-18 18:54
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("identities", "0017_detailkey_count")]
+
+    operations = [
+        migrations.RemoveField(model_name="failedmessagecount", name="notified")
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.8 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("identities", "0018_remove_failedmessagecount_notified")]
+
+    operations = [
+        migrations.AddField(
+            model_name="outboxevent",
+            name="claimed_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="When this was leased to a dispatch_hooks process.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="outboxevent",
+            name="claimed_by",
+            field=models.CharField(
+                blank=True,
+                help_text="The dispatch_hooks process that this is leased to.",
+                max_length=255,
+                null=True,
+            ),
+        ),
+    ]
@@ -1,19 +1,374 @@
 import uuid
+from datetime import timedelta
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.core.cache import cache, caches
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models.signals import post_save, pre_save
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
+from rest_framework.authtoken.models import Token
+from rest_hooks.models import HOOK_EVENTS, Hook
 from rest_hooks.signals import raw_hook_event
 
+from seed_identity_store.auth import (
+    invalidate_cached_credentials,
+    invalidate_cached_token,
+)
 
-class IdentityManager(models.Manager):
-    def filter_by_addr(self, address_type, address):
-        filter_string = "details__addresses__%s__has_key" % (address_type,)
-        return self.filter(**{filter_string: address})
+locmem_cache = caches["locmem"]
+
+
+def iter_addresses(details):
+    """
+    Yields (address_type, address, metadata) for every address in the given
+    identity details, skipping anything that isn't structured as expected.
+    """
+    if not isinstance(details, dict):
+        return
+    addresses = details.get("addresses")
+    if not isinstance(addresses, dict):
+        return
+    for address_type, values in addresses.items():
+        if not isinstance(values, dict):
+            continue
+        for address, metadata in values.items():
+            if not isinstance(metadata, dict):
+                metadata = {}
+            yield address_type, address, metadata
+
+
+def address_flags(metadata):
+    """
+    The optedout, inactive, and default flags of an address, as stored on
+    IdentityAddress.
+    """
+    return {
+        flag: metadata.get(flag) in [True, "True", "true"]
+        for flag in ("optedout", "inactive", "default")
+    }
+
+
+def detail_addresses(details):
+    """
+    Maps (address_type, address) to the flags of each address in the given
+    identity details.
+    """
+    return {
+        (address_type, address): address_flags(metadata)
+        for address_type, address, metadata in iter_addresses(details)
+    }
+
+
+def detail_key_paths(details, depth=None):
+    """
+    Returns the dotted paths of the keys in the given identity details, e.g.
+    "addresses" and "addresses.msisdn", up to DETAIL_KEY_DEPTH levels deep.
+    """
+    if depth is None:
+        depth = settings.DETAIL_KEY_DEPTH
+    paths = set()
+    if not isinstance(details, dict) or depth < 1:
+        return paths
+    for key, value in details.items():
+        paths.add(key)
+        paths.update(
+            "{}.{}".format(key, path) for path in detail_key_paths(value, depth - 1)
+        )
+    return paths
+
+
+# Counts the identities with each detail key path, up to %(depth)s levels deep,
+# for the identities with ids in the range (%(start)s, %(end)s]
+DETAIL_KEY_COUNTS_SQL = """
+WITH RECURSIVE paths (path, value, depth) AS (
+    SELECT e.key, e.value, 1
+    FROM {table} AS i, jsonb_each(i.details) AS e
+    WHERE jsonb_typeof(i.details) = 'object'
+    AND (%(start)s::uuid IS NULL OR i.id > %(start)s::uuid)
+    AND (%(end)s::uuid IS NULL OR i.id <= %(end)s::uuid)
+    UNION ALL
+    SELECT p.path || '.' || e.key, e.value, p.depth + 1
+    FROM paths AS p, jsonb_each(p.value) AS e
+    WHERE p.depth < %(depth)s AND jsonb_typeof(p.value) = 'object'
+)
+SELECT path, count(*) FROM paths GROUP BY path
+"""
+
+
+# Sets "optedout": true on every address of every type in the details
+OPTOUT_ALL_SQL = """
+CASE WHEN jsonb_typeof(details -> 'addresses') = 'object' THEN jsonb_set(
+    details,
+    '{addresses}',
+    (
+        SELECT COALESCE(jsonb_object_agg(t.key, CASE
+            WHEN jsonb_typeof(t.value) = 'object' THEN (
+                SELECT COALESCE(jsonb_object_agg(a.key, CASE
+                    WHEN jsonb_typeof(a.value) = 'object'
+                    THEN a.value || '{"optedout": true}'
+                    ELSE a.value
+                END), '{}')
+                FROM jsonb_each(t.value) a
+            )
+            ELSE t.value
+        END), '{}')
+        FROM jsonb_each(details -> 'addresses') t
+    )
+) ELSE details END
+"""
+
+
+class IdentityQuerySet(models.QuerySet):
+    def filter_by_addr(self, address_type, address, include_inactive=True):
+        return self._filter_addresses(
+            include_inactive,
+            addresses__address_type=address_type,
+            addresses__address=address,
+        )
+
+    def filter_by_addrs(self, address_type, addresses, include_inactive=True):
+        """
+        Like filter_by_addr, but matches any of the given addresses in a single
+        query.
+        """
+        return self._filter_addresses(
+            include_inactive,
+            addresses__address_type=address_type,
+            addresses__address__in=addresses,
+        )
+
+    def _filter_addresses(self, include_inactive, **filters):
+        if not include_inactive:
+            filters["addresses__inactive"] = False
+        return self.filter(**filters)
+
+
+class IdentityManager(models.Manager.from_queryset(IdentityQuerySet)):
+    def bulk_create_identities(self, identities):
+        """
+        Creates all the identities with a single insert. bulk_create doesn't
+        send post_save, so the work of the post_save receivers is done here,
+        once for the whole batch. With HOOK_OUTBOX, the hooks are written to
+        the outbox in the same transaction as the identities.
+        """
+        from .tasks import deliver_hooks_in_batches
+
+        with transaction.atomic():
+            identities = self.bulk_create(identities)
+            IdentityAddress.objects.bulk_create(
+                IdentityAddress(
+                    identity=identity,
+                    address_type=address_type,
+                    address=address,
+                    **address_flags(metadata)
+                )
+                for identity in identities
+                for address_type, address, metadata in iter_addresses(identity.details)
+            )
+            key_names = set()
+            for identity in identities:
+                key_names.update(detail_key_paths(identity.details))
+            DetailKey.objects.record(unseen_detail_keys(key_names))
+            if settings.HOOK_OUTBOX:
+                deliver_hooks_in_batches("identity.created", identities)
+
+        if not settings.HOOK_OUTBOX:
+            deliver_hooks_in_batches("identity.created", identities)
+        return identities
+
+    def _identity_target(self, identity_id=None, msisdn=None):
+        """
+        The SQL condition and params for the identity with the given id, or
+        else the first identity, by id, with the given msisdn.
+        """
+        if identity_id is not None:
+            return "id = %s", [identity_id]
+        return (
+            "id = (SELECT identity_id FROM {addresses} "
+            "WHERE address_type = 'msisdn' AND address = %s "
+            "ORDER BY identity_id LIMIT 1)".format(
+                addresses=connection.ops.quote_name(IdentityAddress._meta.db_table)
+            ),
+            [msisdn],
+        )
+
+    def get_identity_id(self, identity_id=None, msisdn=None):
+        """
+        The id of the identity that the failed message count methods would
+        update, or None if no identity matched.
+        """
+        target, params = self._identity_target(identity_id, msisdn)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT id FROM {table} WHERE {target}".format(
+                    table=connection.ops.quote_name(self.model._meta.db_table),
+                    target=target,
+                ),
+                params,
+            )
+            row = cursor.fetchone()
+        return row[0] if row is not None else None
+
+    def increment_failed_message_count(self, identity_id=None, msisdn=None):
+        """
+        Adds one to the failed message count of the identity in a single
+        upsert of its FailedMessageCount row. Returns the identity id and the
+        new count, or None if no identity matched.
+        """
+        target, params = self._identity_target(identity_id, msisdn)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO {counts} AS c "
+                "(identity_id, count, last_failure_at) "
+                "SELECT id, 1, %s FROM {table} WHERE {target} "
+                "ON CONFLICT (identity_id) DO UPDATE "
+                "SET count = c.count + 1, last_failure_at = EXCLUDED.last_failure_at "
+                "RETURNING identity_id, count".format(
+                    counts=connection.ops.quote_name(FailedMessageCount._meta.db_table),
+                    table=connection.ops.quote_name(self.model._meta.db_table),
+                    target=target,
+                ),
+                [timezone.now()] + params,
+            )
+            return cursor.fetchone()
+
+    def reset_failed_message_count(self, identity_id=None, msisdn=None):
+        """
+        Sets the failed message count of the identity to 0 in a single
+        statement, which only writes the count if it isn't already 0.
+        Returns the identity id and the new count, or None if no identity
+        matched.
+        """
+        target, params = self._identity_target(identity_id, msisdn)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "WITH target AS (SELECT id FROM {table} WHERE {target}), "
+                "reset AS (UPDATE {counts} SET count = 0 "
+                "WHERE identity_id IN (SELECT id FROM target) "
+                "AND count <> 0 RETURNING count) "
+                "SELECT id, 0 FROM target".format(
+                    counts=connection.ops.quote_name(FailedMessageCount._meta.db_table),
+                    table=connection.ops.quote_name(self.model._meta.db_table),
+                    target=target,
+                ),
+                params,
+            )
+            return cursor.fetchone()
+
+    def apply_failed_message_counts(self, counts):
+        """
+        Applies the folded results of a batch of delivery reports in a single
+        upsert. counts maps identity ids to (reset, failures), where reset is
+        whether there was a successful delivery, and failures is the number of
+        failed deliveries after the last successful one. Returns a list of the
+        identity id, and the counts before and after the batch, for each of
+        the identities that exist.
+        """
+        if not counts:
+            return []
+        values = []
+        for identity_id, (reset, failures) in counts.items():
+            values.extend([identity_id, reset, failures])
+        reset_ids = [i for i, (reset, _) in counts.items() if reset]
+        previous_counts = {}
+        with transaction.atomic(savepoint=False):
+            # A reset replaces the count, so the count before it is locked and
+            # read first
+            if reset_ids:
+                previous_counts = dict(
+                    FailedMessageCount.objects.filter(identity_id__in=reset_ids)
+                    .order_by("identity_id")
+                    .select_for_update()
+                    .values_list("identity_id", "count")
+                )
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "WITH v (id, reset, failures) AS (VALUES {values}), "
+                    "updated AS (INSERT INTO {counts} AS c "
+                    "(identity_id, count, last_failure_at) "
+                    "SELECT v.id, v.failures, "
+                    "CASE WHEN v.failures > 0 THEN %s::timestamptz END "
+                    "FROM v JOIN {table} AS i ON i.id = v.id "
+                    "WHERE v.failures > 0 "
+                    "OR EXISTS (SELECT 1 FROM {counts} WHERE identity_id = v.id) "
+                    "ON CONFLICT (identity_id) DO UPDATE SET "
+                    "count = CASE "
+                    "WHEN (SELECT reset FROM v WHERE v.id = EXCLUDED.identity_id) "
+                    "THEN EXCLUDED.count ELSE c.count + EXCLUDED.count END, "
+                    "last_failure_at = "
+                    "COALESCE(EXCLUDED.last_failure_at, c.last_failure_at) "
+                    "WHERE EXCLUDED.count > 0 OR c.count <> 0 "
+                    "RETURNING c.identity_id, c.count) "
+                    "SELECT i.id, u.count FROM v JOIN {table} AS i ON i.id = v.id "
+                    "LEFT JOIN updated AS u ON u.identity_id = i.id".format(
+                        values=", ".join(["(%s::uuid, %s, %s)"] * len(counts)),
+                        counts=connection.ops.quote_name(
+                            FailedMessageCount._meta.db_table
+                        ),
+                        table=connection.ops.quote_name(self.model._meta.db_table),
+                    ),
+                    values + [timezone.now()],
+                )
+                rows = cursor.fetchall()
+        results = []
+        for identity_id, count in rows:
+            reset, failures = counts[identity_id]
+            if reset:
+                results.append(
+                    (identity_id, previous_counts.get(identity_id, 0), failures)
+                )
+            else:
+                # Identities without a reset always have failures to update
+                results.append((identity_id, count - failures, count))
+        return results
+
+    def detail_key_counts(self, start=None, end=None):
+        """
+        Returns the number of identities with each detail key path, for the
+        identities with ids after start, up to and including end. This only
+        reads the identities, so it doesn't block changes to them.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                DETAIL_KEY_COUNTS_SQL.format(
+                    table=connection.ops.quote_name(self.model._meta.db_table)
+                ),
+                {
+                    "start": None if start is None else str(start),
+                    "end": None if end is None else str(end),
+                    "depth": settings.DETAIL_KEY_DEPTH,
+                },
+            )
+            return dict(cursor.fetchall())
+
+    def load_hook_users(self, identities):
+        """
+        Loads the created_by and updated_by users of the identities, for their
+        hook payloads, with a single query for any that aren't loaded yet.
+        """
+        fields = [self.model._meta.get_field(f) for f in ("created_by", "updated_by")]
+        users, missing = {}, []
+        for identity in identities:
+            for field in fields:
+                if field.is_cached(identity):
+                    user = field.get_cached_value(identity)
+                    if user is not None:
+                        users[user.pk] = user
+                elif getattr(identity, field.attname) is not None:
+                    missing.append((identity, field))
+        user_ids = {getattr(i, f.attname) for i, f in missing} - set(users)
+        if user_ids:
+            users.update(User.objects.in_bulk(user_ids))
+        for identity, field in missing:
+            field.set_cached_value(
+                identity, users.get(getattr(identity, field.attname))
+            )
 
 
 @python_2_unicode_compatible
@@ -38,12 +393,6 @@ class Identity(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     version = models.IntegerField(default=1)
     details = JSONField()
-    failed_message_count = models.IntegerField(
-        default=0,
-        help_text="Count of consecutive failed messages to user",
-        null=True,
-        blank=True,
-    )
     communicate_through = models.ForeignKey(
         "self",
         related_name="identities_communicate_through",
@@ -67,6 +416,9 @@ class Identity(models.Model):
         User, related_name="identities_updated", null=True, on_delete=models.SET_NULL
     )
     user = property(lambda self: self.created_by)
+    # The detail key paths and addresses as they were loaded from the database
+    _loaded_detail_keys = None
+    _loaded_addresses = None
 
     objects = IdentityManager()
 
@@ -74,27 +426,67 @@ class Identity(models.Model):
         indexes = [
             models.Index(fields=["-created_at"]),
             models.Index(fields=["-updated_at"]),
+            GinIndex(
+                fields=["details"],
+                name="identities_details_gin_idx",
+                opclasses=["jsonb_path_ops"],
+            ),
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Identity, cls).from_db(db, field_names, values)
+        if "details" in instance.__dict__:
+            instance.snapshot_details()
+        return instance
+
+    def snapshot_details(self):
+        """
+        Records what the post_save receivers need to know about the details as
+        they are in the database, to tell what has changed when the identity is
+        saved. Only the key paths and addresses are kept, so that the details,
+        which may be changed in place, don't need to be copied.
+        """
+        self._loaded_detail_keys = frozenset(detail_key_paths(self.details))
+        self._loaded_addresses = detail_addresses(self.details)
+
     def serialize_hook(self, hook):
+        # The users are only loaded if the hook's payload needs them. An
+        # identity's string is its ID, so the related identities aren't needed.
+        data = {
+            "id": str(self.id),
+            "version": self.version,
+            "details": self.details,
+            "communicate_through": str(self.communicate_through_id),
+            "operator": str(self.operator_id),
+            "created_at": self.created_at.isoformat(),
+            "created_by": lambda: self.hook_username("created_by"),
+            "updated_at": self.updated_at.isoformat(),
+            "updated_by": lambda: self.hook_username("updated_by"),
+        }
         return {
             "hook": hook.dict(),
-            "data": {
-                "id": str(self.id),
-                "version": self.version,
-                "details": self.details,
-                "communicate_through": str(self.communicate_through),
-                "operator": str(self.operator),
-                "created_at": self.created_at.isoformat(),
-                "created_by": self.created_by.username,
-                "updated_at": self.updated_at.isoformat(),
-                "updated_by": self.updated_by.username,
-            },
+            "data": HookConfig.for_hook(hook).project_payload(hook.event, data),
         }
 
+    def hook_username(self, field_name):
+        Identity.objects.load_hook_users([self])
+        user = getattr(self, field_name)
+        return None if user is None else user.username
+
     def __str__(self):
         return str(self.id)
 
+    @property
+    def failed_message_count(self):
+        """
+        Count of consecutive failed messages to user
+        """
+        try:
+            return self.failed_message_counter.count
+        except FailedMessageCount.DoesNotExist:
+            return 0
+
     def remove_details(self, user):
         updated_details = {}
         for attribute, value in self.details.items():
@@ -107,19 +499,84 @@ class Identity(models.Model):
         self.updated_by = user
         self.save()
 
+    def sync_addresses(self):
+        """
+        Brings the IdentityAddress rows for this identity in line with
+        details["addresses"], only writing the rows that have changed.
+        """
+        wanted = detail_addresses(self.details)
+        existing = {
+            (a.address_type, a.address): a
+            for a in IdentityAddress.objects.filter(identity=self)
+        }
+
+        removed = [a.id for key, a in existing.items() if key not in wanted]
+        if removed:
+            IdentityAddress.objects.filter(id__in=removed).delete()
+
+        created = []
+        for (address_type, address), flags in wanted.items():
+            current = existing.get((address_type, address))
+            if current is None:
+                created.append(
+                    IdentityAddress(
+                        identity=self,
+                        address_type=address_type,
+                        address=address,
+                        **flags
+                    )
+                )
+            elif any(getattr(current, k) != v for k, v in flags.items()):
+                IdentityAddress.objects.filter(id=current.id).update(**flags)
+        if created:
+            IdentityAddress.objects.bulk_create(created)
+
+    def _update_details(self, details_sql, params):
+        """
+        Sets details to the result of details_sql in a single UPDATE, so that
+        concurrent changes to other parts of the details aren't lost. The rest
+        of the row isn't written. Returns the updated details.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {table} SET details = {details}, updated_at = %s "
+                "WHERE id = %s RETURNING details, updated_at".format(
+                    table=connection.ops.quote_name(self._meta.db_table),
+                    details=details_sql,
+                ),
+                params + [timezone.now(), self.id],
+            )
+            row = cursor.fetchone()
+        if row is not None:
+            self.details, self.updated_at = row
+            self.snapshot_details()
+        return self.details
+
     def optout_address(self, scope, address_type=None, address=None):
-        # for each address type (e.g. email, msisdn, etc.)
-        for cur_address_type, addresses in self.details["addresses"].items():
-            if scope == "all" or cur_address_type == address_type:
-                # for each address value (e.g. foo1@bar.com, +27123, etc.)
-                for cur_address, cur_details in addresses.items():
-                    if scope == "all" or cur_address == address:
-                        cur_details["optedout"] = True
-        self.save()
+        if scope == "all":
+            # for each address type (e.g. email, msisdn, etc.), and each
+            # address value (e.g. foo1@bar.com, +27123, etc.)
+            details = self._update_details(OPTOUT_ALL_SQL, [])
+            IdentityAddress.objects.filter(identity=self).update(optedout=True)
+        else:
+            details = self._update_details(
+                "jsonb_set(details, %s, 'true')",
+                [["addresses", address_type, address, "optedout"]],
+            )
+            IdentityAddress.objects.filter(
+                identity=self, address_type=address_type, address=address
+            ).update(optedout=True)
+        return details
 
     def optin_address(self, address_type=None, address=None):
-        self.details["addresses"][address_type][address]["optedout"] = False
-        self.save()
+        details = self._update_details(
+            "jsonb_set(details, %s, 'false')",
+            [["addresses", address_type, address, "optedout"]],
+        )
+        IdentityAddress.objects.filter(
+            identity=self, address_type=address_type, address=address
+        ).update(optedout=False)
+        return details
 
     def get_addresses_list(self, address_type, default_only=False):
         response = []
@@ -143,6 +600,57 @@ class Identity(models.Model):
         return response
 
 
+@python_2_unicode_compatible
+class IdentityAddress(models.Model):
+    """
+    A lookup table of the addresses in Identity.details["addresses"], so that
+    identities can be found by address without scanning the details JSON.
+    Kept in sync by Identity.sync_addresses.
+    """
+
+    identity = models.ForeignKey(
+        Identity, related_name="addresses", on_delete=models.CASCADE
+    )
+    address_type = models.CharField(
+        max_length=50, help_text="Address type, e.g. msisdn or email."
+    )
+    address = models.TextField(help_text="The address value.")
+    optedout = models.BooleanField(default=False)
+    inactive = models.BooleanField(default=False)
+    default = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ("address_type", "address", "identity")
+
+    def __str__(self):
+        return "%s:%s" % (self.address_type, self.address)
+
+
+@python_2_unicode_compatible
+class FailedMessageCount(models.Model):
+    """
+    The count of consecutive failed messages to an identity. Delivery reports
+    update this often, so it is kept out of the much wider identity row. A
+    missing row means a count of 0.
+    """
+
+    identity = models.OneToOneField(
+        Identity,
+        primary_key=True,
+        related_name="failed_message_counter",
+        on_delete=models.CASCADE,
+    )
+    count = models.IntegerField(
+        default=0, help_text="Count of consecutive failed messages to user"
+    )
+    last_failure_at = models.DateTimeField(
+        null=True, blank=True, help_text="Time of the last failed message."
+    )
+
+    def __str__(self):
+        return "%s: %s" % (self.identity_id, self.count)
+
+
 @python_2_unicode_compatible
 class OptIn(models.Model):
     """An opt-in"""
@@ -345,20 +853,408 @@ class OptOut(models.Model):
                 )
 
 
+DETAIL_KEYS_GENERATION_KEY = "detailkeys:generation"
+
+
+class DetailKeyManager(models.Manager):
+    def generation(self):
+        """
+        Identifies the current list of detail keys. It changes whenever keys
+        are added.
+        """
+        generation = cache.get(DETAIL_KEYS_GENERATION_KEY)
+        if generation is None:
+            cache.add(DETAIL_KEYS_GENERATION_KEY, uuid.uuid4().hex, None)
+            generation = cache.get(DETAIL_KEYS_GENERATION_KEY)
+        return generation
+
+    def bump_generation(self):
+        # A random value can't repeat an earlier generation if the cache is lost
+        transaction.on_commit(
+            lambda: cache.set(DETAIL_KEYS_GENERATION_KEY, uuid.uuid4().hex, None)
+        )
+
+    def key_names(self, generation):
+        """
+        Returns the list of key names for the given generation, from the
+        default cache if possible.
+        """
+        cache_key = "detailkeys:names:{}".format(generation)
+        key_names = cache.get(cache_key)
+        if key_names is None:
+            key_names = list(self.values_list("key_name", flat=True))
+            cache.set(cache_key, key_names)
+        return key_names
+
+    def storable(self, key_names):
+        max_length = self.model._meta.get_field("key_name").max_length
+        return [key_name for key_name in key_names if len(key_name) <= max_length]
+
+    def record(self, key_names):
+        """
+        Adds the given key names, skipping any that already exist, in a single
+        insert. The generation only changes if any keys were added.
+        """
+        key_names = self.storable(key_names)
+        if not key_names:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO {table} (key_name, count, created_at) "
+                "SELECT v.key_name, 1, %s FROM (VALUES {values}) AS v (key_name) "
+                "ON CONFLICT (key_name) DO NOTHING RETURNING key_name".format(
+                    table=connection.ops.quote_name(self.model._meta.db_table),
+                    values=", ".join(["(%s)"] * len(key_names)),
+                ),
+                [timezone.now()] + list(key_names),
+            )
+            if cursor.fetchall():
+                self.bump_generation()
+
+    def set_counts(self, counts):
+        """
+        Sets the count of each detail key to the given counts, adding any
+        keys that are missing, and setting the count of the others to 0. The
+        generation only changes if any keys were added.
+        """
+        counts = {k: counts[k] for k in self.storable(counts)}
+        values = []
+        for key_name, count in counts.items():
+            values.extend([key_name, count])
+        with transaction.atomic():
+            self.exclude(key_name__in=list(counts)).exclude(count=0).update(count=0)
+            if not counts:
+                return
+            with connection.cursor() as cursor:
+                # xmax is 0 for inserted rows, and set for updated ones
+                cursor.execute(
+                    "INSERT INTO {table} AS k (key_name, count, created_at) "
+                    "SELECT v.key_name, v.count, %s FROM (VALUES {values}) "
+                    "AS v (key_name, count) "
+                    "ON CONFLICT (key_name) DO UPDATE SET count = EXCLUDED.count "
+                    "WHERE k.count <> EXCLUDED.count "
+                    "RETURNING k.xmax = 0".format(
+                        table=connection.ops.quote_name(self.model._meta.db_table),
+                        values=", ".join(["(%s, %s)"] * len(counts)),
+                    ),
+                    [timezone.now()] + values,
+                )
+                if any(inserted for (inserted,) in cursor.fetchall()):
+                    self.bump_generation()
+
+
 @python_2_unicode_compatible
 class DetailKey(models.Model):
     """
     This is a list of all unique keys in the details column of the Identity
-    model. Used to help build filters. Populated by post_save triggers.
+    model, including nested keys as dotted paths. Used to help build filters.
+    Populated by post_save triggers, and counted by reconcile_detail_keys.
     """
 
     key_name = models.CharField(null=False, max_length=200, primary_key=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    count = models.IntegerField(
+        default=1,
+        help_text="The number of identities with this key, as of the last "
+        "reconciliation.",
+    )
+
+    objects = DetailKeyManager()
 
     def __str__(self):
         return str(self.key_name)
 
 
+KNOWN_DETAIL_KEYS_KEY = "detailkeys:known"
+
+
+def unseen_detail_keys(key_names):
+    """
+    Returns the key names that this process hasn't seen yet, and remembers
+    them, so that DetailKey only needs to be written to for new keys. The
+    known keys are forgotten after the default cache timeout, in case they
+    failed to be written.
+    """
+    known = locmem_cache.get(KNOWN_DETAIL_KEYS_KEY, frozenset())
+    unseen = set(key_names) - known
+    if unseen:
+        locmem_cache.set(KNOWN_DETAIL_KEYS_KEY, known | unseen)
+    return unseen
+
+
+@python_2_unicode_compatible
+class HookConfig(models.Model):
+    """
+    Delivery options for a Hook. Hooks without one use the defaults.
+    """
+
+    PAYLOAD_FULL = "full"
+    PAYLOAD_ID = "id"
+    PAYLOAD_FIELDS = "fields"
+    PAYLOAD_MODE_CHOICES = (
+        (PAYLOAD_FULL, "The full payload"),
+        (PAYLOAD_ID, "Only the identity's ID"),
+        (PAYLOAD_FIELDS, "Only the fields in payload_fields"),
+    )
+
+    hook = models.OneToOneField(
+        Hook, primary_key=True, related_name="config", on_delete=models.CASCADE
+    )
+    batch_size = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="If set, deliveries are posted together as a JSON array of "
+        "up to this many payloads.",
+    )
+    batch_window = models.PositiveIntegerField(
+        default=5,
+        help_text="The maximum number of seconds to wait for a batch to fill "
+        "before posting it.",
+    )
+    payload_mode = models.CharField(
+        max_length=6,
+        choices=PAYLOAD_MODE_CHOICES,
+        default=PAYLOAD_FULL,
+        help_text="Which parts of the event data are delivered.",
+    )
+    payload_fields = JSONField(
+        default=list,
+        blank=True,
+        help_text="The fields of the event data to deliver, for the fields "
+        "payload mode. Nested fields can be given as dotted paths, e.g. "
+        "details.name",
+    )
+
+    def __str__(self):
+        return str(self.hook_id)
+
+    def project_payload(self, event_name, data):
+        """
+        Returns the parts of the event data that this hook's payload mode
+        delivers. Callable values are only called if they are delivered.
+        """
+        if self.payload_mode == self.PAYLOAD_ID:
+            fields = [HOOK_EVENT_ID_FIELDS.get(event_name, "id")]
+        elif self.payload_mode == self.PAYLOAD_FIELDS:
+            fields = self.payload_fields
+        else:
+            fields = list(data)
+
+        projected = {}
+        for field in fields:
+            path = field.split(".")
+            value = data
+            for key in path:
+                if not isinstance(value, dict) or key not in value:
+                    break
+                value = value[key]
+                if callable(value):
+                    value = value()
+            else:
+                parent = projected
+                for key in path[:-1]:
+                    parent = parent.setdefault(key, {})
+                parent[path[-1]] = value
+        return projected
+
+    @classmethod
+    def for_hook(cls, hook):
+        try:
+            return hook.config
+        except cls.DoesNotExist:
+            return cls(hook=hook)
+
+
+# The field of each event's data that holds the identity's ID, which is all
+# that hooks with the id payload mode are sent
+HOOK_EVENT_ID_FIELDS = {
+    "identity.created": "id",
+    "identity.max_failures": "identity_id",
+    "optin.requested": "identity",
+    "optout.requested": "identity",
+}
+
+HOOK_CACHE_GENERATION_KEY = "hooks:generation"
+
+# Passed to get_hooks for the hooks of all users, as None is no user
+ALL_USERS = object()
+
+
+def get_hooks(event_name, user):
+    """
+    Returns the hooks subscribed to event_name, for the given user, or for all
+    users if user is ALL_USERS, with their HookConfig. There are no hooks for
+    a user of None. These are cached in this process for HOOK_CACHE_TIMEOUT
+    seconds, or until a Hook or HookConfig is changed in this process.
+    """
+    if user is None:
+        return []
+    generation = locmem_cache.get_or_set(HOOK_CACHE_GENERATION_KEY, 0, None)
+    user_id = "all" if user is ALL_USERS else getattr(user, "pk", user)
+    key = "hooks:{}:{}:{}".format(generation, event_name, user_id)
+    hooks = locmem_cache.get(key)
+    if hooks is None:
+        queryset = Hook.objects.filter(event=event_name).select_related("config")
+        if user is not ALL_USERS:
+            queryset = queryset.filter(user_id=user_id)
+        hooks = list(queryset)
+        locmem_cache.set(key, hooks, settings.HOOK_CACHE_TIMEOUT)
+    return hooks
+
+
+@receiver(post_save, sender=Hook)
+@receiver(post_delete, sender=Hook)
+@receiver(post_save, sender=HookConfig)
+@receiver(post_delete, sender=HookConfig)
+def invalidate_hook_cache(sender, **kwargs):
+    # Entries for older generations are no longer used, and expire
+    locmem_cache.add(HOOK_CACHE_GENERATION_KEY, 0, None)
+    locmem_cache.incr(HOOK_CACHE_GENERATION_KEY)
+
+
+def find_and_fire_hook(event_name, instance, user_override=None):
+    """
+    Used as rest_hooks' HOOK_FINDER, to fire the hooks for model events from
+    the hook cache instead of querying for them every time.
+    """
+    if event_name not in HOOK_EVENTS:
+        raise Exception(
+            '"{}" does not exist in `settings.HOOK_EVENTS`.'.format(event_name)
+        )
+
+    # rest_hooks fires "+" events, like identity.created, for all users
+    user = ALL_USERS
+    if user_override is not False:
+        if user_override:
+            user = user_override
+        elif hasattr(instance, "user"):
+            user = instance.user
+        elif isinstance(instance, User):
+            user = instance
+        else:
+            raise Exception(
+                "{} has no `user` property. REST Hooks needs this.".format(
+                    repr(instance)
+                )
+            )
+
+    for hook in get_hooks(event_name, user):
+        hook.deliver_hook(instance)
+
+
+# Replaces rest_hooks' receiver, so that the hooks come from the hook cache
+raw_hook_event.disconnect(dispatch_uid="raw-custom-hook")
+
+
+@receiver(raw_hook_event, dispatch_uid="raw-custom-hook")
+def raw_custom_event(
+    sender, event_name, payload, user, send_hook_meta=True, instance=None, **kwargs
+):
+    for hook in get_hooks(event_name, user):
+        new_payload = HookConfig.for_hook(hook).project_payload(event_name, payload)
+        if send_hook_meta:
+            new_payload = {"hook": hook.dict(), "data": new_payload}
+        hook.deliver_hook(instance, payload_override=new_payload)
+
+
+class OutboxEventQuerySet(models.QuerySet):
+    def unclaimed(self):
+        """
+        The events that aren't leased to a dispatch_hooks process, including
+        those whose lease has expired.
+        """
+        expired = timezone.now() - timedelta(
+            seconds=settings.HOOK_DISPATCHER_LEASE_TIMEOUT
+        )
+        return self.filter(
+            models.Q(claimed_at__isnull=True) | models.Q(claimed_at__lt=expired)
+        )
+
+
+@python_2_unicode_compatible
+class OutboxEvent(models.Model):
+    """
+    A webhook delivery waiting to be queued. These are written in the same
+    transaction as the change that fired the hook, and queued for delivery by
+    the dispatch_outbox task once that transaction has committed.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    hook = models.ForeignKey(
+        Hook, help_text="The hook that fired.", on_delete=models.CASCADE
+    )
+    target = models.URLField(max_length=255, help_text="The target URL.")
+    payload = JSONField(help_text="The payload to deliver.")
+    instance_id = models.CharField(
+        null=True,
+        blank=True,
+        max_length=255,
+        help_text="The ID of the instance that triggered the hook.",
+    )
+    batched = models.BooleanField(
+        default=False,
+        help_text="Whether this is to be delivered in a batch by "
+        "deliver_hook_batch, instead of by itself.",
+    )
+    claimed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When this was leased to a dispatch_hooks process.",
+    )
+    claimed_by = models.CharField(
+        null=True,
+        blank=True,
+        max_length=255,
+        help_text="The dispatch_hooks process that this is leased to.",
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = OutboxEventQuerySet.as_manager()
+
+    def __str__(self):
+        return "%s: %s" % (self.hook_id, self.target)
+
+    def delivery(self):
+        """
+        The keyword arguments for DeliverHook to deliver this event.
+        """
+        return dict(
+            target=self.target,
+            payload=self.payload,
+            instance_id=self.instance_id,
+            hook_id=self.hook_id,
+        )
+
+
+@python_2_unicode_compatible
+class HookDeadLetter(models.Model):
+    """
+    A webhook delivery that was given up on, either because the target
+    rejected it, or because it still failed after HOOK_MAX_RETRIES retries.
+    """
+
+    hook = models.ForeignKey(
+        Hook,
+        null=True,
+        help_text="The hook that the delivery was for.",
+        on_delete=models.SET_NULL,
+    )
+    target = models.URLField(max_length=255, help_text="The target URL.")
+    payload = JSONField(help_text="The payload that was to be delivered.")
+    instance_id = models.CharField(
+        null=True,
+        blank=True,
+        max_length=255,
+        help_text="The ID of the instance that triggered the hook.",
+    )
+    attempts = models.IntegerField(help_text="The number of delivery attempts made.")
+    error = models.TextField(help_text="The error from the last attempt.")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.target, self.error)
+
+
 @receiver(pre_save, sender=OptOut)
 def optout_saved(sender, instance, **kwargs):
     """
@@ -407,11 +1303,42 @@ def handle_optout(sender, instance, created, **kwargs):
         identity.optout_address(scope="all")
 
 
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    invalidate_cached_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_credentials(sender, instance, **kwargs):
+    # e.g. so that deactivated users, or old passwords, can no longer be used
+    invalidate_cached_credentials(instance.get_username())
+    for key in Token.objects.filter(user_id=instance.pk).values_list("key", flat=True):
+        invalidate_cached_token(key)
+
+
+@receiver(post_save, sender=Identity)
+def sync_identity_addresses(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and "details" not in update_fields:
+        return
+    # The IdentityAddress rows only change if the addresses have
+    addresses = detail_addresses(instance.details)
+    if addresses != instance._loaded_addresses:
+        instance.sync_addresses()
+    instance._loaded_addresses = addresses
+
+
 @receiver(post_save, sender=Identity)
-def fire_detailkeys_if_new(sender, instance, created, **kwargs):
+def fire_detailkeys_if_new(sender, instance, created, update_fields=None, **kwargs):
     from .tasks import populate_detail_key
 
-    if created and instance.details is not None:
-        populate_detail_key.apply_async(
-            kwargs={"key_names": list(instance.details.keys())}
-        )
+    if update_fields is not None and "details" not in update_fields:
+        return
+    # Only the keys added since the identity was loaded can be new
+    detail_keys = frozenset(detail_key_paths(instance.details))
+    key_names = detail_keys - (instance._loaded_detail_keys or frozenset())
+    instance._loaded_detail_keys = detail_keys
+    key_names = unseen_detail_keys(key_names)
+    if key_names:
+        populate_detail_key.apply_async(kwargs={"key_names": sorted(key_names)})
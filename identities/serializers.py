@@ -1,8 +1,9 @@
+from django.conf import settings
 from django.contrib.auth.models import Group, User
 from rest_framework import serializers
 from rest_hooks.models import Hook
 
-from .models import Identity, OptIn, OptOut
+from .models import HookConfig, Identity, OptIn, OptOut
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -21,9 +22,17 @@ class CreateUserSerializer(serializers.Serializer):
     email = serializers.EmailField()
 
 
+class IdentityListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        return Identity.objects.bulk_create_identities(
+            [Identity(**attrs) for attrs in validated_data]
+        )
+
+
 class IdentitySerializer(serializers.ModelSerializer):
     class Meta:
         model = Identity
+        list_serializer_class = IdentityListSerializer
         read_only_fields = ("created_at", "updated_at")
         fields = (
             "id",
@@ -71,11 +80,121 @@ class OptInSerializer(serializers.ModelSerializer):
 
 
 class HookSerializer(serializers.ModelSerializer):
+    # Stored on the hook's HookConfig
+    config_fields = ("batch_size", "batch_window", "payload_mode", "payload_fields")
+    batch_size = serializers.IntegerField(
+        required=False, allow_null=True, min_value=1, max_value=settings.MAX_BATCH_SIZE
+    )
+    batch_window = serializers.IntegerField(required=False, min_value=1)
+    payload_mode = serializers.ChoiceField(
+        choices=HookConfig.PAYLOAD_MODE_CHOICES, required=False
+    )
+    payload_fields = serializers.ListField(
+        child=serializers.CharField(), required=False
+    )
+
     class Meta:
         model = Hook
         read_only_fields = ("user",)
         fields = "__all__"
 
+    def validate(self, data):
+        if self.instance is not None:
+            config = HookConfig.for_hook(self.instance)
+        else:
+            config = HookConfig()
+        mode = data.get("payload_mode", config.payload_mode)
+        fields = data.get("payload_fields", config.payload_fields)
+        if mode == HookConfig.PAYLOAD_FIELDS and not fields:
+            raise serializers.ValidationError(
+                {"payload_fields": "Required for the fields payload mode."}
+            )
+        return data
+
+    def to_representation(self, instance):
+        data = super(HookSerializer, self).to_representation(instance)
+        config = HookConfig.for_hook(instance)
+        for field in self.config_fields:
+            data[field] = getattr(config, field)
+        return data
+
+    def create(self, validated_data):
+        config = self.pop_config(validated_data)
+        hook = super(HookSerializer, self).create(validated_data)
+        self.save_config(hook, config)
+        return hook
+
+    def update(self, instance, validated_data):
+        config = self.pop_config(validated_data)
+        hook = super(HookSerializer, self).update(instance, validated_data)
+        self.save_config(hook, config)
+        return hook
+
+    def pop_config(self, validated_data):
+        return {
+            field: validated_data.pop(field)
+            for field in self.config_fields
+            if field in validated_data
+        }
+
+    def save_config(self, hook, config):
+        if config:
+            hook.config, _ = HookConfig.objects.update_or_create(
+                hook=hook, defaults=config
+            )
+
 
 class AddressSerializer(serializers.Serializer):
     address = serializers.CharField(max_length=500)
+
+
+def validate_batch_size(value):
+    if len(value) > settings.MAX_BATCH_SIZE:
+        raise serializers.ValidationError(
+            "A maximum of %s items can be sent in one request."
+            % settings.MAX_BATCH_SIZE
+        )
+    return value
+
+
+class AddressLookupSerializer(serializers.Serializer):
+    address_type = serializers.CharField(max_length=50)
+    address = serializers.CharField()
+
+
+class BulkAddressSearchSerializer(serializers.Serializer):
+    addresses = AddressLookupSerializer(many=True, allow_empty=False)
+    include_inactive = serializers.BooleanField(default=True)
+
+    def validate_addresses(self, value):
+        return validate_batch_size(value)
+
+
+class BulkIdentityAddressesSerializer(serializers.Serializer):
+    identities = serializers.ListField(child=serializers.UUIDField(), allow_empty=False)
+    address_type = serializers.CharField(max_length=50)
+    default = serializers.BooleanField(default=False)
+    use_communicate_through = serializers.BooleanField(default=False)
+
+    def validate_identities(self, value):
+        return validate_batch_size(value)
+
+
+class DeliveryReportSerializer(serializers.Serializer):
+    # Blank values are allowed for identity and to_addr, as they are for the
+    # single delivery report endpoint
+    identity = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    to_addr = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    delivered = serializers.BooleanField()
+
+    def validate_identity(self, value):
+        if value:
+            return serializers.UUIDField().to_internal_value(value)
+        return value
+
+    def validate(self, data):
+        if not data.get("identity") and not data.get("to_addr"):
+            raise serializers.ValidationError(
+                'Either "identity" or "to_addr" must be supplied'
+            )
+        return data
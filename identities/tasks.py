@@ -1,12 +1,214 @@
+import hashlib
 import json
+import logging
+import os
+import random
+import time
 import uuid
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+from urllib.parse import urlparse
 
 import requests
 from celery.task import Task
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from prometheus_client import Counter
+from requests.adapters import HTTPAdapter
+from rest_hooks.models import Hook
+from rest_hooks.signals import raw_hook_event
 from seed_papertrail.decorators import papertrail
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
-from .models import DetailKey
+from .models import (
+    ALL_USERS,
+    DetailKey,
+    HookConfig,
+    HookDeadLetter,
+    Identity,
+    OutboxEvent,
+    get_hooks,
+)
+
+logger = logging.getLogger(__name__)
+
+HOOK_REQUESTS = Counter(
+    "hook_delivery_requests_total", "Webhook delivery requests sent", ["host"]
+)
+HOOK_CONNECTIONS = Counter(
+    "hook_delivery_connections_total",
+    "New connections opened for webhook deliveries. Requests that didn't open a "
+    "new connection reused a pooled one.",
+    ["host"],
+)
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        HOOK_CONNECTIONS.labels(self.host).inc()
+        return super(CountingHTTPConnectionPool, self)._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        HOOK_CONNECTIONS.labels(self.host).inc()
+        return super(CountingHTTPSConnectionPool, self)._new_conn()
+
+
+class HookAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super(HookAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    The requests Session used to deliver hooks from this process, so that
+    connections to the hook targets are kept open and reused between
+    deliveries. Sockets can't be shared with forked worker processes, so each
+    process gets its own.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HookAdapter(
+            pool_connections=settings.HOOK_POOL_CONNECTIONS,
+            pool_maxsize=settings.HOOK_POOL_MAXSIZE,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def retry_countdown(retries):
+    """
+    The number of seconds to wait before the next attempt at a delivery that
+    has already been retried the given number of times. The backoff doubles
+    with each retry, and is jittered so that deliveries that failed together
+    aren't all retried together.
+    """
+    delay = min(
+        settings.HOOK_RETRY_BACKOFF_MAX, settings.HOOK_RETRY_BACKOFF * 2 ** retries
+    )
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def circuit_key(target, name):
+    target_hash = hashlib.md5(target.encode("utf-8")).hexdigest()
+    return "hook_circuit:%s:%s" % (target_hash, name)
+
+
+def circuit_allows(target):
+    """
+    Whether a delivery to the target should be attempted. The circuit for a
+    target is opened for HOOK_CIRCUIT_RESET_TIMEOUT seconds after
+    HOOK_CIRCUIT_FAILURE_THRESHOLD consecutive failures. Once that has passed,
+    a single delivery is let through, and the circuit is only closed again if
+    that delivery succeeds.
+    """
+    state = cache.get_many(
+        [circuit_key(target, "open"), circuit_key(target, "tripped")]
+    )
+    if circuit_key(target, "open") in state:
+        return False
+    if circuit_key(target, "tripped") in state:
+        return cache.add(
+            circuit_key(target, "probe"),
+            True,
+            settings.HOOK_CONNECT_TIMEOUT + settings.HOOK_READ_TIMEOUT,
+        )
+    return True
+
+
+def record_target_success(target):
+    cache.delete_many(
+        [
+            circuit_key(target, "failures"),
+            circuit_key(target, "tripped"),
+            circuit_key(target, "probe"),
+        ]
+    )
+
+
+def record_target_failure(target):
+    timeout = settings.HOOK_CIRCUIT_RESET_TIMEOUT
+    failures_key = circuit_key(target, "failures")
+    if cache.get(circuit_key(target, "tripped")) is None:
+        cache.add(failures_key, 0, timeout)
+        if cache.incr(failures_key) < settings.HOOK_CIRCUIT_FAILURE_THRESHOLD:
+            return
+    cache.set(circuit_key(target, "open"), True, timeout)
+    # Remembered for longer than the circuit is open, so that a failure of the
+    # probe delivery opens the circuit again straight away
+    cache.set(circuit_key(target, "tripped"), True, timeout * 10)
+    cache.delete_many([failures_key, circuit_key(target, "probe")])
+
+
+def is_retryable_status(status_code):
+    """
+    Server errors and rate limiting are worth retrying. Other error responses
+    will fail the same way again.
+    """
+    return status_code >= 500 or status_code == 429
+
+
+def is_retryable(exception):
+    """
+    Connection errors and timeouts are worth retrying, as are some error
+    responses.
+    """
+    response = getattr(exception, "response", None)
+    if response is None:
+        return True
+    return is_retryable_status(response.status_code)
+
+
+def hook_headers():
+    return {
+        "Content-Type": "application/json",
+        "Authorization": "Token %s" % settings.HOOK_AUTH_TOKEN,
+    }
+
+
+def circuit_open_countdown(retries):
+    return max(settings.HOOK_CIRCUIT_RESET_TIMEOUT, retry_countdown(retries))
+
+
+def retry_delivery(delivery, retries, error, countdown=None):
+    """
+    Queues another attempt at the delivery, or gives up on it if it has
+    already been retried HOOK_MAX_RETRIES times.
+    """
+    if retries >= settings.HOOK_MAX_RETRIES:
+        return dead_letter(delivery, retries + 1, error)
+    if countdown is None:
+        countdown = retry_countdown(retries)
+    DeliverHook.apply_async(kwargs=delivery, countdown=countdown, retries=retries + 1)
+
+
+def dead_letter(delivery, attempts, error):
+    hook_id = delivery["hook_id"]
+    if hook_id is not None and not Hook.objects.filter(id=hook_id).exists():
+        hook_id = None
+    HookDeadLetter.objects.create(
+        hook_id=hook_id,
+        target=delivery["target"],
+        payload=delivery["payload"],
+        instance_id=delivery["instance_id"],
+        attempts=attempts,
+        error=error,
+    )
 
 
 class DeliverHook(Task):
@@ -17,14 +219,35 @@ class DeliverHook(Task):
         instance_id:   a possibly None "trigger" instance ID
         hook_id:       the ID of defining Hook object
         """
-        requests.post(
-            url=target,
-            data=json.dumps(payload),
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": "Token %s" % settings.HOOK_AUTH_TOKEN,
-            },
+        delivery = dict(
+            target=target, payload=payload, instance_id=instance_id, hook_id=hook_id
         )
+        retries = self.request.retries
+        if not circuit_allows(target):
+            return retry_delivery(
+                delivery,
+                retries,
+                "Circuit open for target",
+                countdown=circuit_open_countdown(retries),
+            )
+
+        HOOK_REQUESTS.labels(urlparse(target).hostname).inc()
+        try:
+            response = get_session().post(
+                url=target,
+                data=json.dumps(payload),
+                headers=hook_headers(),
+                timeout=(settings.HOOK_CONNECT_TIMEOUT, settings.HOOK_READ_TIMEOUT),
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if not is_retryable(e):
+                # The target is up, it just didn't accept this delivery
+                record_target_success(target)
+                return dead_letter(delivery, retries + 1, str(e))
+            record_target_failure(target)
+            return retry_delivery(delivery, retries, str(e))
+        record_target_success(target)
 
 
 def deliver_hook_wrapper(target, payload, instance, hook):
@@ -38,9 +261,180 @@ def deliver_hook_wrapper(target, payload, instance, hook):
     kwargs = dict(
         target=target, payload=payload, instance_id=instance_id, hook_id=hook.id
     )
+    config = HookConfig.for_hook(hook)
+    if config.batch_size:
+        queue_batched_deliveries(config, [kwargs])
+        return
+    if settings.HOOK_OUTBOX:
+        OutboxEvent.objects.create(**kwargs)
+        return
     DeliverHook.apply_async(kwargs=kwargs)
 
 
+class DeliverHooks(DeliverHook):
+    def run(self, deliveries, **kwargs):
+        """
+        deliveries: a list of the keyword arguments for DeliverHook, so that
+                    many hooks can be queued as a single task.
+        """
+        for delivery in deliveries:
+            super(DeliverHooks, self).run(**delivery)
+
+
+def deliver_hooks_in_batches(event_name, instances):
+    """
+    Fires the hooks subscribed to event_name for all of the identities in
+    instances, queueing HOOK_BATCH_SIZE deliveries per task instead of one
+    task per delivery. Like rest_hooks' "created+" events, this fires for the
+    hooks of all users.
+    """
+    hooks = get_hooks(event_name, ALL_USERS)
+    if hooks:
+        Identity.objects.load_hook_users(instances)
+    for hook in hooks:
+        deliveries = [
+            dict(
+                target=hook.target,
+                payload=hook.serialize_hook(instance),
+                instance_id=str(instance.id),
+                hook_id=hook.id,
+            )
+            for instance in instances
+        ]
+        config = HookConfig.for_hook(hook)
+        if config.batch_size:
+            queue_batched_deliveries(config, deliveries)
+            continue
+        if settings.HOOK_OUTBOX:
+            OutboxEvent.objects.bulk_create(
+                OutboxEvent(**delivery) for delivery in deliveries
+            )
+            continue
+        size = settings.HOOK_BATCH_SIZE
+        for start in range(0, len(deliveries), size):
+            end = start + size
+            DeliverHooks.apply_async(kwargs={"deliveries": deliveries[start:end]})
+
+
+def hook_batch_keys(hook_id):
+    return ("hook_batch:%s:pending" % hook_id, "hook_batch:%s:scheduled" % hook_id)
+
+
+def queue_batched_deliveries(config, deliveries):
+    """
+    Adds the deliveries for a hook with batching enabled to the outbox, to be
+    posted together by deliver_hook_batch.
+    """
+    OutboxEvent.objects.bulk_create(
+        OutboxEvent(batched=True, **delivery) for delivery in deliveries
+    )
+    transaction.on_commit(lambda: schedule_hook_batch(config, len(deliveries)))
+
+
+def schedule_hook_batch(config, count):
+    """
+    Queues deliver_hook_batch for the hook straight away if it has a full
+    batch waiting, or else once its batch window has passed, if that hasn't
+    already been done.
+    """
+    pending_key, scheduled_key = hook_batch_keys(config.hook_id)
+    cache.add(pending_key, 0, config.batch_window * 2)
+    if cache.incr(pending_key, count) >= config.batch_size:
+        cache.delete(pending_key)
+        deliver_hook_batch.apply_async(kwargs={"hook_id": config.hook_id})
+    elif cache.add(scheduled_key, True, config.batch_window * 2):
+        deliver_hook_batch.apply_async(
+            kwargs={"hook_id": config.hook_id}, countdown=config.batch_window
+        )
+
+
+class DeliverHookBatch(Task):
+
+    """ Posts the batched deliveries in the outbox for a hook, as JSON arrays
+        of up to the hook's batch_size payloads
+    """
+
+    name = "seed_identity_store.identities.tasks.deliver_hook_batch"
+
+    def run(self, hook_id, **kwargs):
+        # Anything added from here on needs another run scheduled
+        cache.delete_many(hook_batch_keys(hook_id))
+        config = (
+            HookConfig.objects.filter(hook_id=hook_id).select_related("hook").first()
+        )
+        # If batching was turned off, deliver what is left one at a time
+        size = config.batch_size if config is not None and config.batch_size else 1
+
+        delivered = 0
+        while True:
+            with transaction.atomic():
+                events = list(
+                    OutboxEvent.objects.select_for_update(skip_locked=True)
+                    .filter(hook_id=hook_id, batched=True)
+                    .order_by("id")[:size]
+                )
+                if not events:
+                    break
+                if size == 1:
+                    [event] = events
+                    DeliverHook.apply_async(kwargs=event.delivery())
+                else:
+                    DeliverHook.apply_async(
+                        kwargs=dict(
+                            target=config.hook.target,
+                            payload=[event.payload for event in events],
+                            instance_id=None,
+                            hook_id=hook_id,
+                        )
+                    )
+                OutboxEvent.objects.filter(id__in=[e.id for e in events]).delete()
+            delivered += len(events)
+            if len(events) < size:
+                break
+        return "Delivered <%s> batched hook deliveries" % delivered
+
+
+deliver_hook_batch = DeliverHookBatch()
+
+
+class DispatchOutbox(Task):
+
+    """ Queues the deliveries in the outbox, in batches of HOOK_BATCH_SIZE.
+        Rows that another dispatch is busy with, or that are leased to a
+        dispatch_hooks process, are skipped, so that many of these can run at
+        once. If HOOK_DISPATCHER is set, only the rows that the dispatch_hooks
+        command hasn't claimed within a lease timeout are queued.
+    """
+
+    name = "seed_identity_store.identities.tasks.dispatch_outbox"
+
+    def run(self, **kwargs):
+        outbox = OutboxEvent.objects.unclaimed().filter(batched=False)
+        if settings.HOOK_DISPATCHER:
+            outbox = outbox.filter(
+                created_at__lt=timezone.now()
+                - timedelta(seconds=settings.HOOK_DISPATCHER_LEASE_TIMEOUT)
+            )
+        outbox = outbox.select_for_update(skip_locked=True).order_by("id")
+        dispatched = 0
+        while True:
+            with transaction.atomic():
+                events = list(outbox[: settings.HOOK_BATCH_SIZE])
+                if not events:
+                    break
+                # If queueing fails, the events are left in the outbox for the
+                # next dispatch
+                DeliverHooks.apply_async(
+                    kwargs={"deliveries": [event.delivery() for event in events]}
+                )
+                OutboxEvent.objects.filter(id__in=[e.id for e in events]).delete()
+            dispatched += len(events)
+        return "Dispatched <%s> hook deliveries" % dispatched
+
+
+dispatch_outbox = DispatchOutbox()
+
+
 class PopulateDetailKey(Task):
 
     """ Fires last created subscriptions count
@@ -50,12 +444,264 @@ class PopulateDetailKey(Task):
 
     @papertrail.debug(name)
     def run(self, key_names):
-        existing_keys = DetailKey.objects.values_list("key_name", flat=True)
-        # get key_names NOT in existing_keys
-        new_items = [n for n in key_names if n not in existing_keys]
-        for i in new_items:
-            DetailKey.objects.create(key_name=i)
-        return "Added <%s> new DetailKey records" % len(new_items)
+        # Keys that already exist, possibly added by another worker, are skipped
+        DetailKey.objects.record(key_names)
+        return "Recorded <%s> DetailKey records" % len(key_names)
 
 
 populate_detail_key = PopulateDetailKey()
+
+
+class ReconcileDetailKeys(Task):
+
+    """ Recounts the identities with each detail key, and adds any keys that
+        are missing, a batch of identities at a time
+    """
+
+    name = "seed_identity_store.identities.tasks.reconcile_detail_keys"
+
+    def run(self, **kwargs):
+        counts = defaultdict(int)
+        ids = Identity.objects.order_by("id").values_list("id", flat=True)
+        size = settings.DETAIL_KEY_RECONCILE_BATCH_SIZE
+        start = None
+        while True:
+            batch = ids if start is None else ids.filter(id__gt=start)
+            # The last id in this batch, or None for the last batch
+            last = size - 1
+            end = batch[last:size].first()
+            for key_name, count in Identity.objects.detail_key_counts(
+                start, end
+            ).items():
+                counts[key_name] += count
+            if end is None:
+                break
+            start = end
+        DetailKey.objects.set_counts(counts)
+        return "Reconciled <%s> DetailKey records" % len(counts)
+
+
+reconcile_detail_keys = ReconcileDetailKeys()
+
+
+def fire_max_send_failures_hook(user, identity_id, failure_count):
+    raw_hook_event.send(
+        sender=None,
+        event_name="identity.max_failures",
+        payload={"identity_id": str(identity_id), "failure_count": failure_count},
+        user=user,
+    )
+
+
+def max_failures_crossings(previous_count, failed_message_count):
+    """
+    The failed message counts, after previous_count and up to
+    failed_message_count, at which the identity.max_failures hook fires. It
+    fires once when the count reaches MAX_CONSECUTIVE_SEND_FAILURES, and again
+    only after a successful delivery resets the count. If
+    MAX_FAILURES_RENOTIFY_INTERVAL is set, it also fires again every that many
+    failures after the maximum.
+    """
+    max_failures = settings.MAX_CONSECUTIVE_SEND_FAILURES
+    interval = settings.MAX_FAILURES_RENOTIFY_INTERVAL
+    if failed_message_count < max_failures:
+        return []
+    if not interval:
+        return [max_failures] if previous_count < max_failures else []
+    # The first count after previous_count that is notified on
+    first = max(previous_count + 1, max_failures)
+    first += -(first - max_failures) % interval
+    return list(range(first, failed_message_count + 1, interval))
+
+
+def reached_max_failures(previous_count, failed_message_count):
+    """
+    Whether the identity.max_failures hook should fire for a failed message
+    count going from previous_count to failed_message_count.
+    """
+    return bool(max_failures_crossings(previous_count, failed_message_count))
+
+
+# The folds of no delivery reports, a successful one, and a failed one, for
+# fold_delivery_reports
+NO_DELIVERY_REPORTS = (False, 0, (), 0)
+DELIVERED_REPORT = (True, 0, (), 0)
+FAILED_REPORT = (False, 1, (), 1)
+
+
+def fold_delivery_reports(earlier, later):
+    """
+    Combines the folds of two consecutive runs of delivery reports to an
+    identity. A fold is (reset, head, crossings, failures): whether there was
+    a successful delivery, the number of failures before the first successful
+    one, the failed message counts at which the identity.max_failures hook
+    fires in the runs of failures between two successful ones, and the number
+    of failures after the last successful one.
+    """
+    reset, head, crossings, failures = earlier
+    later_reset, later_head, later_crossings, later_failures = later
+    if not later_reset:
+        if not reset:
+            head += later_failures
+        return (reset, head, crossings, failures + later_failures)
+    if not reset:
+        return (True, failures + later_head, later_crossings, later_failures)
+    crossings += tuple(max_failures_crossings(0, failures + later_head))
+    return (True, head, crossings + later_crossings, later_failures)
+
+
+def apply_delivery_reports(folds, users):
+    """
+    Applies the folds of delivery reports for each identity, from
+    fold_delivery_reports, to the failed message counts. The
+    identity.max_failures hook is fired, for the user in users, at each
+    failed message count that it would have been for the reports one at a
+    time. Returns the ids of the identities that exist.
+    """
+    counts = OrderedDict(
+        (identity_id, (reset, failures))
+        for identity_id, (reset, _, _, failures) in folds.items()
+    )
+    applied = Identity.objects.apply_failed_message_counts(counts)
+    for identity_id, previous_count, failed_message_count in applied:
+        reset, head, crossings, failures = folds[identity_id]
+        crossings = list(crossings)
+        if reset:
+            # The run of failures that was ended by the first successful
+            # delivery
+            crossings[:0] = max_failures_crossings(
+                previous_count, previous_count + head
+            )
+            previous_count = 0
+        crossings += max_failures_crossings(previous_count, failed_message_count)
+        for failure_count in crossings:
+            fire_max_send_failures_hook(users[identity_id], identity_id, failure_count)
+    return set(identity_id for identity_id, _, _ in applied)
+
+
+# How long buffered delivery reports are kept in the cache if they aren't
+# flushed, and how many intervals are looked back over if the last flush
+# isn't known
+BUFFER_TIMEOUT = 24 * 60 * 60
+FLUSH_LOOKBACK = 60
+
+
+def buffer_key(epoch, *parts):
+    return ":".join(["failed_message_count", str(epoch)] + [str(p) for p in parts])
+
+
+def buffer_delivery_report(user, identity_id, delivered):
+    """
+    Records a delivery report in the cache, to be applied to the failed
+    message count by flush_failed_message_counts. Reports are kept in buckets
+    of FAILED_MESSAGE_COUNT_FLUSH_INTERVAL seconds. For each identity in a
+    bucket, the cache holds the number of failures, and if there was a
+    successful delivery, the number of failures there were at the first and
+    last ones, and the failed message counts at which the
+    identity.max_failures hook fires in the runs of failures between them.
+    """
+    epoch = int(time.time() // settings.FAILED_MESSAGE_COUNT_FLUSH_INTERVAL)
+    failures_key = buffer_key(epoch, identity_id, "failures")
+    if cache.add(failures_key, 0, BUFFER_TIMEOUT):
+        # First report for this identity in the bucket, so add it to the
+        # bucket's list of identities
+        entries_key = buffer_key(epoch, "entries")
+        cache.add(entries_key, 0, BUFFER_TIMEOUT)
+        entry = cache.incr(entries_key)
+        cache.set(buffer_key(epoch, "entry", entry), str(identity_id), BUFFER_TIMEOUT)
+    if delivered:
+        failures = cache.get(failures_key)
+        reset_key = buffer_key(epoch, identity_id, "reset")
+        reset_at = cache.get(reset_key)
+        if reset_at is None:
+            cache.set(buffer_key(epoch, identity_id, "head"), failures, BUFFER_TIMEOUT)
+        else:
+            crossings = max_failures_crossings(0, failures - reset_at)
+            if crossings:
+                crossings_key = buffer_key(epoch, identity_id, "crossings")
+                crossings = cache.get(crossings_key, []) + crossings
+                cache.set(crossings_key, crossings, BUFFER_TIMEOUT)
+        cache.set(reset_key, failures, BUFFER_TIMEOUT)
+    else:
+        cache.incr(failures_key)
+    cache.set(buffer_key(epoch, identity_id, "user"), user.id, BUFFER_TIMEOUT)
+
+
+class FlushFailedMessageCounts(Task):
+
+    """ Applies the delivery reports buffered by buffer_delivery_report to the
+        failed message counts, and fires the identity.max_failures hooks
+    """
+
+    name = "seed_identity_store.identities.tasks.flush_failed_message_counts"
+    last_flushed_key = "failed_message_count:last_flushed"
+
+    def run(self, **kwargs):
+        interval = settings.FAILED_MESSAGE_COUNT_FLUSH_INTERVAL
+        if not interval:
+            return "Delivery report buffering is disabled"
+        # Buckets are only flushed once they have been closed for a whole
+        # interval, so that reports still being recorded in them aren't lost
+        current = int(time.time() // interval)
+        last_flushed = cache.get(self.last_flushed_key)
+        if last_flushed is None:
+            last_flushed = current - FLUSH_LOOKBACK
+        epochs = range(last_flushed + 1, current - 1)
+        entry_counts = cache.get_many([buffer_key(e, "entries") for e in epochs])
+
+        counts = OrderedDict()
+        user_ids = {}
+        for epoch in epochs:
+            entries = entry_counts.get(buffer_key(epoch, "entries"))
+            # Claim the bucket, so that it isn't applied by two flushes
+            if not entries or not cache.add(
+                buffer_key(epoch, "flushed"), True, BUFFER_TIMEOUT
+            ):
+                continue
+            entry_keys = [buffer_key(epoch, "entry", i) for i in range(1, entries + 1)]
+            identity_ids = list(cache.get_many(entry_keys).values())
+            keys = [
+                buffer_key(epoch, identity_id, part)
+                for identity_id in identity_ids
+                for part in ("failures", "reset", "head", "crossings", "user")
+            ]
+            values = cache.get_many(keys)
+            for identity_id in identity_ids:
+                failures = values.get(buffer_key(epoch, identity_id, "failures"), 0)
+                reset_at = values.get(buffer_key(epoch, identity_id, "reset"))
+                head = values.get(buffer_key(epoch, identity_id, "head"), 0)
+                crossings = values.get(buffer_key(epoch, identity_id, "crossings"), [])
+                user_id = values.get(buffer_key(epoch, identity_id, "user"))
+                identity_id = uuid.UUID(identity_id)
+                # Fold this bucket into the counts from the earlier buckets
+                if reset_at is not None:
+                    bucket = (True, head, tuple(crossings), failures - reset_at)
+                else:
+                    bucket = (False, failures, (), failures)
+                counts[identity_id] = fold_delivery_reports(
+                    counts.get(identity_id, NO_DELIVERY_REPORTS), bucket
+                )
+                user_ids[identity_id] = user_id
+            cache.delete_many(entry_keys + keys + [buffer_key(epoch, "entries")])
+        cache.set(self.last_flushed_key, max(last_flushed, current - 2), None)
+
+        users = User.objects.in_bulk(set(user_ids.values()))
+        for identity_id, user_id in user_ids.items():
+            if users.get(user_id) is None:
+                logger.warning(
+                    "Skipped the delivery reports for identity %s, as user %s "
+                    "no longer exists",
+                    identity_id,
+                    user_id,
+                )
+                del counts[identity_id]
+        identity_ids = list(counts.keys())
+        size = settings.MAX_BATCH_SIZE
+        for start in range(0, len(identity_ids), size):
+            end = start + size
+            batch = OrderedDict((i, counts[i]) for i in identity_ids[start:end])
+            apply_delivery_reports(batch, {i: users[user_ids[i]] for i in batch})
+        return "Flushed delivery reports for <%s> identities" % len(counts)
+
+
+flush_failed_message_counts = FlushFailedMessageCounts()
@@ -1,18 +1,63 @@
+import base64
 import json
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from socketserver import ThreadingMixIn
+from unittest.mock import patch
 
 import responses
+from django.contrib.auth.hashers import check_password
 from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError, connection, transaction
 from django.db.models.signals import post_save
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from prometheus_client import REGISTRY
 from requests_testadapter import TestAdapter, TestSession
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 from rest_hooks.models import Hook
-
-from .models import DetailKey, Identity, OptIn, OptOut, handle_optin, handle_optout
-from .tasks import deliver_hook_wrapper
+from rest_hooks.signals import raw_hook_event
+
+from .management.commands.dispatch_hooks import Dispatcher
+from .models import (
+    ALL_USERS,
+    DetailKey,
+    FailedMessageCount,
+    HookConfig,
+    HookDeadLetter,
+    Identity,
+    IdentityAddress,
+    OptIn,
+    OptOut,
+    OutboxEvent,
+    get_hooks,
+    handle_optin,
+    handle_optout,
+)
+from .tasks import (
+    DeliverHook,
+    buffer_delivery_report,
+    circuit_key,
+    deliver_hook_batch,
+    deliver_hook_wrapper,
+    deliver_hooks_in_batches,
+    dispatch_outbox,
+    fire_max_send_failures_hook,
+    flush_failed_message_counts,
+    get_session,
+    populate_detail_key,
+    reconcile_detail_keys,
+    schedule_hook_batch,
+)
 
 
 class RecordingAdapter(TestAdapter):
@@ -29,6 +74,10 @@ class RecordingAdapter(TestAdapter):
 
 class APITestCase(TestCase):
     def setUp(self):
+        # What earlier tests cached, e.g. hooks and detail keys, has been
+        # rolled back
+        caches["locmem"].clear()
+        cache.clear()
         self.client = APIClient()
         self.adminclient = APIClient()
         self.session = TestSession()
@@ -433,6 +482,30 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
         self.assertEqual(len(data_exclude["results"]), 1)
         self.assertEqual(data_exclude["results"][0]["details"]["name"], "Test Name 4")
 
+    def test_read_identity_search_inactive_filter_single_query(self):
+        """
+        Excluding inactive addresses should be done in the database, in the
+        same query that finds the identities.
+        """
+        for i in range(3):
+            self.make_identity(
+                {"details": {"addresses": {"msisdn": {"+27123": {"inactive": "true"}}}}}
+            )
+        identity = self.make_identity(
+            {"details": {"addresses": {"msisdn": {"+27123": {"inactive": False}}}}}
+        )
+
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                "/api/v1/identities/search/",
+                {"details__addresses__msisdn": "+27123", "include_inactive": False},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual([r["id"] for r in data["results"]], [str(identity.id)])
+
     def test_read_identity_search_email(self):
         # Setup
         self.make_identity()
@@ -626,6 +699,28 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
         self.assertEqual(len(data["results"]), 1)
         self.assertEqual(data["results"][0]["details"]["name"], "Test Name 2")
 
+    def test_read_identity_search_details_uses_containment(self):
+        """
+        Filters on top level details keys should also be expressed as a JSON
+        containment query, so that they can use the GIN index on details.
+        """
+        self.make_identity()
+        self.make_identity({"details": {"personnel_code": ["12345"], "addresses": {}}})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                "/api/v1/identities/search/",
+                {"details__personnel_code": "12345"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(len(data["results"]), 1)
+        self.assertEqual(data["results"][0]["details"]["name"], "Test Name 1")
+        [query] = [q["sql"] for q in queries if "identities_identity" in q["sql"]]
+        self.assertIn("@>", query)
+
     def test_read_identity_search_version(self):
         # Setup
         self.make_identity()
@@ -848,6 +943,110 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
         self.assertEqual(len(data["results"]), 1)
         self.assertEqual(data["results"][0]["address"], "+27543")
 
+    def test_bulk_identity_addresses(self):
+        identity1 = self.make_identity()
+        identity2 = self.make_identity(
+            {
+                "details": {
+                    "addresses": {"msisdn": {"+27124": {}, "+27125": {"default": True}}}
+                }
+            }
+        )
+        identity3 = self.make_identity(
+            {
+                "details": {"addresses": {"msisdn": {"+27126": {}}}},
+                "communicate_through": identity1,
+            }
+        )
+        data = {
+            "identities": [str(identity1.id), str(identity2.id), str(identity3.id)],
+            "address_type": "msisdn",
+        }
+
+        # One query for auth, and one for the identities
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                "/api/v1/identities/addresses/",
+                json.dumps(data),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "results": [
+                    {"identity": str(identity1.id), "addresses": ["+27123"]},
+                    {"identity": str(identity2.id), "addresses": ["+27124", "+27125"]},
+                    {"identity": str(identity3.id), "addresses": ["+27126"]},
+                ]
+            },
+        )
+
+    def test_bulk_identity_addresses_default_communicate_through(self):
+        identity1 = self.make_identity()
+        identity2 = self.make_identity(
+            {
+                "details": {
+                    "addresses": {"msisdn": {"+27124": {}, "+27125": {"default": True}}}
+                }
+            }
+        )
+        identity3 = self.make_identity(
+            {
+                "details": {"addresses": {"msisdn": {"+27126": {}}}},
+                "communicate_through": identity1,
+            }
+        )
+        missing_id = "6f4b3cf5-1b3c-4a8e-9c1e-9e3a0b6cd5f1"
+        data = {
+            "identities": [str(identity2.id), str(identity3.id), missing_id],
+            "address_type": "msisdn",
+            "default": True,
+            "use_communicate_through": True,
+        }
+
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                "/api/v1/identities/addresses/",
+                json.dumps(data),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "results": [
+                    {"identity": str(identity2.id), "addresses": ["+27125"]},
+                    {"identity": str(identity3.id), "addresses": ["+27123"]},
+                    {"identity": missing_id, "addresses": []},
+                ]
+            },
+        )
+
+    @override_settings(MAX_BATCH_SIZE=1)
+    def test_bulk_identity_addresses_too_many(self):
+        data = {
+            "identities": [
+                "6f4b3cf5-1b3c-4a8e-9c1e-9e3a0b6cd5f1",
+                "0d3c2b7e-6a55-4c8e-8f2e-3f7cf0b1e9a4",
+            ],
+            "address_type": "msisdn",
+        }
+
+        response = self.client.post(
+            "/api/v1/identities/addresses/",
+            json.dumps(data),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.json(),
+            {"identities": ["A maximum of 1 items can be sent in one request."]},
+        )
+
     def test_update_identity(self):
         # Setup
         identity = self.make_identity()
@@ -919,6 +1118,109 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
         self.assertEqual(d.details["name"], "Test Name")
         self.assertEqual(d.version, 1)
 
+    @responses.activate
+    def test_create_identities_bulk(self):
+        hook = Hook.objects.create(
+            user=self.user, event="identity.created", target="http://example.com"
+        )
+        responses.add(responses.POST, "http://example.com", status=200)
+        post_identities = [
+            {
+                "details": {
+                    "name": "Test Name 1",
+                    "addresses": {"msisdn": {"+27123": {}}},
+                }
+            },
+            {"details": {"name": "Test Name 2", "personnel_code": "23456"}},
+            {"details": {"addresses": {"email": {"foo@bar.com": {"default": True}}}}},
+        ]
+
+        response = self.client.post(
+            "/api/v1/identities/bulk/",
+            json.dumps(post_identities),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 3)
+        identities = Identity.objects.in_bulk([i["id"] for i in response.data])
+        self.assertEqual(len(identities), 3)
+        for identity in identities.values():
+            self.assertEqual(identity.created_by, self.user)
+            self.assertEqual(identity.updated_by, self.user)
+        self.assertEqual(
+            sorted(IdentityAddress.objects.values_list("address", "default")),
+            [("+27123", False), ("foo@bar.com", True)],
+        )
+        self.assertEqual(
+            sorted(DetailKey.objects.values_list("key_name", flat=True)),
+            [
+                "addresses",
+                "addresses.email",
+                "addresses.msisdn",
+                "name",
+                "personnel_code",
+            ],
+        )
+
+        self.assertEqual(len(responses.calls), 3)
+        payloads = [json.loads(call.request.body) for call in responses.calls]
+        self.assertEqual(
+            {p["data"]["id"]: p for p in payloads},
+            {str(i.id): i.serialize_hook(hook) for i in identities.values()},
+        )
+
+    @override_settings(HOOK_BATCH_SIZE=2)
+    @patch("identities.tasks.DeliverHooks.apply_async")
+    def test_create_identities_bulk_hooks_batched(self, apply_async):
+        Hook.objects.create(
+            user=self.user, event="identity.created", target="http://example.com"
+        )
+        post_identities = [{"details": {"name": str(i)}} for i in range(3)]
+
+        response = self.client.post(
+            "/api/v1/identities/bulk/",
+            json.dumps(post_identities),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            [len(c[1]["kwargs"]["deliveries"]) for c in apply_async.call_args_list],
+            [2, 1],
+        )
+
+    def test_create_identities_bulk_invalid(self):
+        post_identities = [{"details": {"name": "Test Name 1"}}, {"version": 2}]
+
+        response = self.client.post(
+            "/api/v1/identities/bulk/",
+            json.dumps(post_identities),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.json(), [{}, {"details": ["This field is required."]}]
+        )
+        self.assertEqual(Identity.objects.count(), 0)
+
+    @override_settings(MAX_BATCH_SIZE=1)
+    def test_create_identities_bulk_too_many(self):
+        post_identities = [{"details": {}}, {"details": {}}]
+
+        response = self.client.post(
+            "/api/v1/identities/bulk/",
+            json.dumps(post_identities),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.json(), ["A maximum of 1 items can be sent in one request."]
+        )
+        self.assertEqual(Identity.objects.count(), 0)
+
     def test_create_identity_no_details(self):
         # Setup
         post_identity = {"details": {}}
@@ -939,7 +1241,7 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
 
         # Check
         c = DetailKey.objects.all().count()
-        self.assertEqual(c, 4)
+        self.assertEqual(c, 6)
 
     def test_create_identity_detailkeys_two_new(self):
         # Setup
@@ -952,7 +1254,105 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
 
         # Check
         c = DetailKey.objects.all().count()
-        self.assertEqual(c, 6)
+        self.assertEqual(c, 8)
+
+    @patch("identities.tasks.populate_detail_key.apply_async")
+    def test_create_identity_detailkeys_known(self, apply_async):
+        """
+        Keys that this process has already seen aren't recorded again.
+        """
+        self.make_identity()
+        apply_async.assert_called_once_with(
+            kwargs={
+                "key_names": [
+                    "addresses",
+                    "addresses.email",
+                    "addresses.msisdn",
+                    "default_addr_type",
+                    "name",
+                    "personnel_code",
+                ]
+            }
+        )
+
+        apply_async.reset_mock()
+        self.make_identity()
+        apply_async.assert_not_called()
+
+        self.make_identity(id_data={"details": {"name": "test", "fresh": "as"}})
+        apply_async.assert_called_once_with(kwargs={"key_names": ["fresh"]})
+
+    def test_populate_detail_key_existing(self):
+        DetailKey.objects.create(key_name="name")
+
+        populate_detail_key.run(["name", "fresh"])
+
+        self.assertEqual(
+            sorted(DetailKey.objects.values_list("key_name", flat=True)),
+            ["fresh", "name"],
+        )
+
+    def test_update_identity_detailkeys(self):
+        identity = self.make_identity()
+        identity = Identity.objects.get(id=identity.id)
+
+        with patch("identities.tasks.populate_detail_key.apply_async") as apply_async:
+            response = self.client.patch(
+                "/api/v1/identities/{}/".format(identity.id),
+                json.dumps(
+                    {"details": dict(identity.details, preferences={"language": "eng"})}
+                ),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Only the new keys are recorded
+        apply_async.assert_called_once_with(
+            kwargs={"key_names": ["preferences", "preferences.language"]}
+        )
+
+    @patch("identities.tasks.populate_detail_key.apply_async")
+    def test_update_identity_details_in_place(self, apply_async):
+        identity = Identity.objects.get(id=self.make_identity().id)
+        apply_async.reset_mock()
+
+        identity.details["preferences"] = {"language": "eng"}
+        identity.save()
+        apply_async.assert_called_once_with(
+            kwargs={"key_names": ["preferences", "preferences.language"]}
+        )
+
+        apply_async.reset_mock()
+        identity.details["preferences"]["channel"] = "sms"
+        identity.save()
+        apply_async.assert_called_once_with(
+            kwargs={"key_names": ["preferences.channel"]}
+        )
+
+    @override_settings(DETAIL_KEY_RECONCILE_BATCH_SIZE=2)
+    def test_reconcile_detail_keys(self):
+        self.make_identity()
+        self.make_identity(id_data={"details": {"name": "test", "lang": {"a": 1}}})
+        self.make_identity(id_data={"details": {"name": "test", "lang": "eng"}})
+        DetailKey.objects.create(key_name="removed", count=5)
+        DetailKey.objects.filter(key_name="lang").delete()
+
+        reconcile_detail_keys.run()
+
+        self.assertEqual(
+            dict(DetailKey.objects.values_list("key_name", "count")),
+            {
+                "name": 3,
+                "default_addr_type": 1,
+                "personnel_code": 1,
+                "addresses": 1,
+                "addresses.msisdn": 1,
+                "addresses.email": 1,
+                "lang": 2,
+                "lang.a": 1,
+                "removed": 0,
+            },
+        )
 
     def test_identity_detailkeys_view(self):
         # Setup
@@ -965,18 +1365,149 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
         # Check
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         data = response.json()
-        self.assertEqual(len(data["key_names"]), 4)
+        self.assertEqual(len(data["key_names"]), 6)
         self.assertEqual("default_addr_type" in data["key_names"], True)
+        self.assertEqual("addresses.msisdn" in data["key_names"], True)
+
+    @patch("django.db.transaction.on_commit", lambda func: func())
+    def test_identity_detailkeys_view_cached(self):
+        self.make_identity()
+        response = self.client.get("/api/v1/detailkeys/")
+        etag = response["ETag"]
+
+        # The list, and the token, are cached
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/v1/detailkeys/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(len(response.json()["key_names"]), 6)
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/v1/detailkeys/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Adding a key changes the list
+        self.make_identity(id_data={"details": {"fresh": "as"}})
+        response = self.client.get("/api/v1/detailkeys/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn("fresh", response.json()["key_names"])
+
+    @patch("django.db.transaction.on_commit", lambda func: func())
+    def test_detailkeys_generation_unchanged(self):
+        DetailKey.objects.record(["name"])
+        generation = DetailKey.objects.generation()
+
+        # Existing keys, and changed counts, don't change the list
+        DetailKey.objects.record(["name"])
+        DetailKey.objects.set_counts({"name": 5})
+        self.assertEqual(DetailKey.objects.generation(), generation)
+
+        DetailKey.objects.set_counts({"name": 5, "fresh": 1})
+        self.assertNotEqual(DetailKey.objects.generation(), generation)
+        generation = DetailKey.objects.generation()
+
+        DetailKey.objects.record(["name", "new"])
+        self.assertNotEqual(DetailKey.objects.generation(), generation)
+        self.assertEqual(
+            dict(DetailKey.objects.values_list("key_name", "count")),
+            {"name": 5, "fresh": 1, "new": 1},
+        )
+
+    def test_identity_detailkeys_view_unauthenticated(self):
+        etag = '"{}"'.format(DetailKey.objects.generation())
+        response = APIClient().get("/api/v1/detailkeys/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_bulk_address_search(self):
+        identity1 = self.make_identity()
+        identity2 = self.make_identity(
+            {"details": {"addresses": {"msisdn": {"+27123": {"inactive": True}}}}}
+        )
+        data = {
+            "addresses": [
+                {"address_type": "msisdn", "address": "+27123"},
+                {"address_type": "email", "address": "foo2@bar.com"},
+                {"address_type": "msisdn", "address": "+27555"},
+            ]
+        }
+
+        # One query for auth, and one for each address type
+        with self.assertNumQueries(3):
+            response = self.client.post(
+                "/api/v1/identities/search/bulk/",
+                json.dumps(data),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "results": [
+                    {
+                        "address_type": "msisdn",
+                        "address": "+27123",
+                        "identities": sorted([str(identity1.id), str(identity2.id)]),
+                    },
+                    {
+                        "address_type": "email",
+                        "address": "foo2@bar.com",
+                        "identities": [str(identity1.id)],
+                    },
+                    {"address_type": "msisdn", "address": "+27555", "identities": []},
+                ]
+            },
+        )
+
+    def test_bulk_address_search_exclude_inactive(self):
+        identity = self.make_identity()
+        self.make_identity(
+            {"details": {"addresses": {"msisdn": {"+27123": {"inactive": True}}}}}
+        )
+        data = {
+            "addresses": [{"address_type": "msisdn", "address": "+27123"}],
+            "include_inactive": False,
+        }
+
+        response = self.client.post(
+            "/api/v1/identities/search/bulk/",
+            json.dumps(data),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        [result] = response.json()["results"]
+        self.assertEqual(result["identities"], [str(identity.id)])
+
+    @override_settings(MAX_BATCH_SIZE=1)
+    def test_bulk_address_search_too_many(self):
+        data = {
+            "addresses": [
+                {"address_type": "msisdn", "address": "+27123"},
+                {"address_type": "msisdn", "address": "+27555"},
+            ]
+        }
+
+        response = self.client.post(
+            "/api/v1/identities/search/bulk/",
+            json.dumps(data),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.json(),
+            {"addresses": ["A maximum of 1 items can be sent in one request."]},
+        )
 
     def test_update_failed_message_count_identity_given(self):
         # Setup
         identity = self.make_identity()
-        identity.failed_message_count = 0
-        identity.save()
 
         data = {"data": {"identity": str(identity.id), "delivered": False}}
         # Execute
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(2):
             response = self.client.post(
                 "/api/v1/identities/message_count/",
                 json.dumps(data),
@@ -987,15 +1518,32 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
         d = Identity.objects.last()
         self.assertEqual(d.failed_message_count, 1)
 
+    def test_update_failed_message_count_identity_not_written(self):
+        """
+        The count is kept in its own table, so the identity row shouldn't be
+        written to.
+        """
+        identity = self.make_identity()
+        data = {"data": {"identity": str(identity.id), "delivered": False}}
+
+        self.client.post(
+            "/api/v1/identities/message_count/",
+            json.dumps(data),
+            content_type="application/json",
+        )
+
+        d = Identity.objects.get(id=identity.id)
+        self.assertEqual(d.updated_at, identity.updated_at)
+        self.assertEqual(d.failed_message_count, 1)
+        self.assertIsNotNone(d.failed_message_counter.last_failure_at)
+
     def test_update_failed_message_count_address_given(self):
         # Setup
-        identity = self.make_identity()
-        identity.failed_message_count = None
-        identity.save()
+        self.make_identity()
 
         data = {"data": {"to_addr": "+27123", "delivered": False}}
         # Execute
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             response = self.client.post(
                 "/api/v1/identities/message_count/",
                 json.dumps(data),
@@ -1020,11 +1568,10 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
         )
 
         identity = self.make_identity()
-        identity.failed_message_count = 4
-        identity.save()
+        FailedMessageCount.objects.create(identity=identity, count=4)
         data = {"data": {"identity": str(identity.id), "delivered": False}}
         # Execute
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(3):
             response = self.client.post(
                 "/api/v1/identities/message_count/",
                 json.dumps(data),
@@ -1045,14 +1592,77 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
             {"identity_id": str(d.id), "failure_count": d.failed_message_count},
         )
 
-    def test_update_failed_message_count_reset_on_success(self):
-        # Setup
-        identity = self.make_identity()
-        identity.failed_message_count = 2
-        identity.save()
+    def post_failed_messages(self, identity, count):
+        data = {"data": {"identity": str(identity.id), "delivered": False}}
+        for i in range(count):
+            response = self.client.post(
+                "/api/v1/identities/message_count/",
+                json.dumps(data),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @responses.activate
+    def test_max_failed_message_count_hook_fires_once(self):
+        """
+        The hook should only fire when the maximum is reached, and not for
+        every failure after that, until a successful delivery resets the count.
+        """
+        Hook.objects.create(
+            user=self.user, event="identity.max_failures", target="http://example.com"
+        )
+        responses.add(responses.POST, "http://example.com", status=200)
+        identity = self.make_identity()
+
+        self.post_failed_messages(identity, 8)
+        self.assertEqual(
+            [
+                json.loads(c.request.body)["data"]["failure_count"]
+                for c in responses.calls
+            ],
+            [5],
+        )
+
+        self.client.post(
+            "/api/v1/identities/message_count/",
+            json.dumps({"data": {"identity": str(identity.id), "delivered": True}}),
+            content_type="application/json",
+        )
+        self.post_failed_messages(identity, 5)
+        self.assertEqual(
+            [
+                json.loads(c.request.body)["data"]["failure_count"]
+                for c in responses.calls
+            ],
+            [5, 5],
+        )
+
+    @override_settings(MAX_FAILURES_RENOTIFY_INTERVAL=2)
+    @responses.activate
+    def test_max_failed_message_count_hook_renotify(self):
+        Hook.objects.create(
+            user=self.user, event="identity.max_failures", target="http://example.com"
+        )
+        responses.add(responses.POST, "http://example.com", status=200)
+        identity = self.make_identity()
+
+        self.post_failed_messages(identity, 10)
+
+        self.assertEqual(
+            [
+                json.loads(c.request.body)["data"]["failure_count"]
+                for c in responses.calls
+            ],
+            [5, 7, 9],
+        )
+
+    def test_update_failed_message_count_reset_on_success(self):
+        # Setup
+        identity = self.make_identity()
+        FailedMessageCount.objects.create(identity=identity, count=2)
         data = {"data": {"identity": str(identity.id), "delivered": True}}
         # Execute
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             response = self.client.post(
                 "/api/v1/identities/message_count/",
                 json.dumps(data),
@@ -1079,6 +1689,187 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
                 content_type="application/json",
             )
 
+    @responses.activate
+    def test_bulk_update_failed_message_count(self):
+        hook = Hook.objects.create(
+            user=self.user, event="identity.max_failures", target="http://example.com"
+        )
+        responses.add(responses.POST, "http://example.com", status=200)
+        identity1 = self.make_identity()
+        FailedMessageCount.objects.create(identity=identity1, count=3)
+        identity2 = self.make_identity(
+            {"details": {"addresses": {"msisdn": {"+27555": {}}}}}
+        )
+        FailedMessageCount.objects.create(identity=identity2, count=4)
+        identity3 = self.make_identity(
+            {"details": {"addresses": {"msisdn": {"+27666": {}}}}}
+        )
+        FailedMessageCount.objects.create(identity=identity3, count=6)
+        data = [
+            {"identity": str(identity1.id), "delivered": False},
+            {"to_addr": "+27555", "delivered": False},
+            {"to_addr": "+27123", "delivered": False},
+            {"identity": str(identity2.id), "delivered": True},
+            {"to_addr": "+27555", "delivered": False},
+            {"to_addr": "+27666", "delivered": False},
+            {"to_addr": "+27999", "delivered": False},
+        ]
+
+        # One query for auth, one to look up the addresses, one for the counts
+        # before the reset, one for the update, and one for the hooks
+        with self.assertNumQueries(5):
+            response = self.client.post(
+                "/api/v1/identities/message_count/bulk/",
+                json.dumps(data),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {"unresolved": ["+27999"]})
+        identity1.refresh_from_db()
+        self.assertEqual(identity1.failed_message_count, 5)
+        identity2.refresh_from_db()
+        self.assertEqual(identity2.failed_message_count, 1)
+        identity3.refresh_from_db()
+        self.assertEqual(identity3.failed_message_count, 7)
+
+        # identity2 reached the maximum before it was reset, and identity3
+        # was already past it
+        self.assertEqual(
+            sorted(
+                (json.loads(c.request.body) for c in responses.calls),
+                key=lambda body: body["data"]["identity_id"] != str(identity1.id),
+            ),
+            [
+                {
+                    "hook": hook.dict(),
+                    "data": {"identity_id": str(identity1.id), "failure_count": 5},
+                },
+                {
+                    "hook": hook.dict(),
+                    "data": {"identity_id": str(identity2.id), "failure_count": 5},
+                },
+            ],
+        )
+
+    @patch("identities.tasks.fire_max_send_failures_hook")
+    def test_bulk_update_failed_message_count_reset_after_max(self, fire):
+        identity1 = self.make_identity()
+        FailedMessageCount.objects.create(identity=identity1, count=3)
+        identity2 = self.make_identity()
+        unknown = "c3b5d2b8-5f0e-4b6a-9a3e-4d4c43c8e2a1"
+        data = [{"identity": str(identity1.id), "delivered": d} for d in "FFSF"]
+        data += [{"identity": str(identity2.id), "delivered": d} for d in "SFFFFFSFS"]
+        data += [{"identity": unknown, "delivered": False}]
+
+        response = self.client.post(
+            "/api/v1/identities/message_count/bulk/",
+            json.dumps([dict(r, delivered=r["delivered"] == "S") for r in data]),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {"unresolved": [unknown]})
+        identity1.refresh_from_db()
+        self.assertEqual(identity1.failed_message_count, 1)
+        identity2.refresh_from_db()
+        self.assertEqual(identity2.failed_message_count, 0)
+        # Each identity reached the maximum in a run of failures that was then
+        # reset
+        self.assertEqual(
+            sorted(
+                (args for args, _ in fire.call_args_list),
+                key=lambda args: args[1] != identity1.id,
+            ),
+            [(self.user, identity1.id, 5), (self.user, identity2.id, 5)],
+        )
+
+    def fired_failure_counts(self, reports, previous_count=0):
+        """
+        Posts the delivery reports, "S" for a successful delivery and "F" for
+        a failure, for one identity one at a time and for another in bulk, and
+        returns the failure counts that the hook fired at for each.
+        """
+        Hook.objects.create(
+            user=self.user, event="identity.max_failures", target="http://example.com"
+        )
+        responses.add(responses.POST, "http://example.com", status=200)
+        single, bulk = self.make_identity(), self.make_identity()
+        for identity in (single, bulk):
+            FailedMessageCount.objects.create(identity=identity, count=previous_count)
+
+        for report in reports:
+            self.client.post(
+                "/api/v1/identities/message_count/",
+                json.dumps(
+                    {"data": {"identity": str(single.id), "delivered": report == "S"}}
+                ),
+                content_type="application/json",
+            )
+        self.client.post(
+            "/api/v1/identities/message_count/bulk/",
+            json.dumps(
+                [
+                    {"identity": str(bulk.id), "delivered": report == "S"}
+                    for report in reports
+                ]
+            ),
+            content_type="application/json",
+        )
+
+        fired = {str(single.id): [], str(bulk.id): []}
+        for c in responses.calls:
+            data = json.loads(c.request.body)["data"]
+            fired[data["identity_id"]].append(data["failure_count"])
+        return fired[str(single.id)], fired[str(bulk.id)]
+
+    @responses.activate
+    def test_bulk_update_failed_message_count_runs_between_resets(self):
+        """
+        Each run of failures between successful deliveries that reaches the
+        maximum should fire the hook, as it would one report at a time
+        """
+        single, bulk = self.fired_failure_counts("FFFFFS" * 3)
+
+        self.assertEqual(single, [5, 5, 5])
+        self.assertEqual(bulk, single)
+
+    @override_settings(MAX_FAILURES_RENOTIFY_INTERVAL=2)
+    @responses.activate
+    def test_bulk_update_failed_message_count_renotify(self):
+        """
+        The hook should fire at every renotify point that a run of failures
+        passes, as it would one report at a time
+        """
+        single, bulk = self.fired_failure_counts(
+            "FFFFFSFFFFFFFFSSFFFFFFFF", previous_count=3
+        )
+
+        self.assertEqual(single, [5, 7, 5, 7, 5, 7])
+        self.assertEqual(bulk, single)
+
+    def test_bulk_update_failed_message_count_invalid(self):
+        data = [{"identity": "", "delivered": False}, {"to_addr": "+27123"}]
+
+        response = self.client.post(
+            "/api/v1/identities/message_count/bulk/",
+            json.dumps(data),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.json(),
+            [
+                {
+                    "non_field_errors": [
+                        'Either "identity" or "to_addr" must be supplied'
+                    ]
+                },
+                {"delivered": ["This field is required."]},
+            ],
+        )
+
     def test_update_failed_message_count_no_identity_supplied(self):
         """
         If neither the identity or to_addr fields are populated, we should get
@@ -1096,6 +1887,26 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
             response.data, ['"data" must contain either "identity" or "to_addr" keys']
         )
 
+    def test_update_failed_message_count_nonexisting_identity(self):
+        """
+        If an identity is supplied that doesn't exist, then an error should be
+        returned.
+        """
+        data = {
+            "data": {
+                "identity": "6f4b3cf5-1b3c-4a8e-9c1e-9e3a0b6cd5f1",
+                "delivered": False,
+            }
+        }
+
+        response = self.client.post(
+            "/api/v1/identities/message_count/",
+            json.dumps(data),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, ["No identity found for given id"])
+
     def test_update_failed_message_count_nonexisting_address(self):
         """
         If an address is supplied, that doesn't belong to any identity, then
@@ -1112,6 +1923,339 @@ class TestIdentityAPI(AuthenticatedAPITestCase):
         self.assertEqual(response.data, ["No identity found for given address"])
 
 
+class TestIdentityAddress(AuthenticatedAPITestCase):
+    def get_addresses(self, identity):
+        return sorted(
+            IdentityAddress.objects.filter(identity=identity).values_list(
+                "address_type", "address", "optedout", "inactive", "default"
+            )
+        )
+
+    def test_addresses_created(self):
+        identity = self.make_identity()
+
+        self.assertEqual(
+            self.get_addresses(identity),
+            [
+                ("email", "foo1@bar.com", False, False, True),
+                ("email", "foo2@bar.com", False, False, False),
+                ("msisdn", "+27123", False, False, False),
+            ],
+        )
+
+    def test_addresses_updated(self):
+        identity = self.make_identity()
+        identity.details["addresses"] = {
+            "msisdn": {"+27123": {"inactive": True}, "+27555": {"default": "true"}}
+        }
+        identity.save()
+
+        self.assertEqual(
+            self.get_addresses(identity),
+            [
+                ("msisdn", "+27123", False, True, False),
+                ("msisdn", "+27555", False, False, True),
+            ],
+        )
+
+    def test_addresses_optout_optin(self):
+        identity = self.make_identity()
+
+        identity.optout_address("single", "msisdn", "+27123")
+        self.assertEqual(
+            IdentityAddress.objects.get(identity=identity, address="+27123").optedout,
+            True,
+        )
+
+        identity.optin_address("msisdn", "+27123")
+        self.assertEqual(
+            IdentityAddress.objects.get(identity=identity, address="+27123").optedout,
+            False,
+        )
+
+    def test_optout_keeps_concurrent_changes(self):
+        """
+        Opting out should only change the opted out flags, and not overwrite
+        changes made to the details by something else in the meantime.
+        """
+        identity = self.make_identity()
+        Identity.objects.filter(id=identity.id).update(details={"name": "Changed"})
+        other = Identity.objects.get(id=identity.id)
+        other.details["addresses"] = {"msisdn": {"+27123": {}}}
+        other.save()
+
+        details = identity.optout_address("single", "msisdn", "+27123")
+
+        expected = {
+            "name": "Changed",
+            "addresses": {"msisdn": {"+27123": {"optedout": True}}},
+        }
+        self.assertEqual(details, expected)
+        self.assertEqual(identity.details, expected)
+        identity.refresh_from_db()
+        self.assertEqual(identity.details, expected)
+
+    def test_optout_all_missing_addresses(self):
+        identity = self.make_identity({"details": {"name": "Test Name 1"}})
+
+        details = identity.optout_address("all")
+
+        self.assertEqual(details, {"name": "Test Name 1"})
+
+    def test_optin_keeps_concurrent_changes(self):
+        identity = self.make_identity()
+        other = Identity.objects.get(id=identity.id)
+        other.details["name"] = "Changed"
+        other.save()
+
+        details = identity.optin_address("msisdn", "+27123")
+
+        self.assertEqual(details["name"], "Changed")
+        self.assertEqual(
+            details["addresses"]["msisdn"], {"+27123": {"optedout": False}}
+        )
+
+    def test_addresses_removed_with_details(self):
+        identity = self.make_identity()
+        identity.remove_details(self.user)
+
+        self.assertEqual(self.get_addresses(identity), [])
+
+    def test_addresses_unstructured(self):
+        """
+        Address details that aren't structured as expected shouldn't be
+        indexed, and shouldn't stop the identity from being saved.
+        """
+        identity = self.make_identity(
+            {"details": {"addresses": "msisdn:+27123 email:foo@bar.com"}}
+        )
+
+        self.assertEqual(self.get_addresses(identity), [])
+
+    def test_addresses_not_synced_for_other_fields(self):
+        identity = self.make_identity()
+        identity.version = 2
+
+        with self.assertNumQueries(1):
+            identity.save(update_fields=["version"])
+
+    def test_addresses_not_synced_if_unchanged(self):
+        identity = Identity.objects.get(id=self.make_identity().id)
+        identity.details["name"] = "Changed"
+
+        # Only the update, as the detail keys and addresses haven't changed
+        with self.assertNumQueries(1):
+            identity.save()
+
+        identity.details["addresses"]["msisdn"]["+27123"]["inactive"] = True
+        identity.save()
+        self.assertIn(
+            ("msisdn", "+27123", False, True, False), self.get_addresses(identity)
+        )
+
+    def test_filter_by_addr(self):
+        identity = self.make_identity()
+        self.make_identity({"details": {"addresses": {"msisdn": {"+27555": {}}}}})
+
+        self.assertEqual(
+            list(Identity.objects.filter_by_addr("msisdn", "+27123")), [identity]
+        )
+        self.assertEqual(list(Identity.objects.filter_by_addr("email", "+27123")), [])
+
+
+@override_settings(FAILED_MESSAGE_COUNT_FLUSH_INTERVAL=60)
+class TestBufferedFailedMessageCount(AuthenticatedAPITestCase):
+    def setUp(self):
+        super(TestBufferedFailedMessageCount, self).setUp()
+        cache.clear()
+        patcher = patch("identities.tasks.time")
+        self.time = patcher.start().time
+        self.time.return_value = 6000
+        self.addCleanup(patcher.stop)
+
+    def post_report(self, delivered, **data):
+        data["delivered"] = delivered
+        return self.client.post(
+            "/api/v1/identities/message_count/",
+            json.dumps({"data": data}),
+            content_type="application/json",
+        )
+
+    def test_reports_buffered(self):
+        """
+        Delivery reports should only be applied to the database once their
+        interval has passed, and the flush task has run.
+        """
+        identity = self.make_identity()
+
+        # One query for auth, and one to look up the identity
+        with self.assertNumQueries(2):
+            response = self.post_report(False, identity=str(identity.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.post_report(False, to_addr="+27123")
+
+        self.time.return_value = 6060
+        flush_failed_message_counts.run()
+        identity.refresh_from_db()
+        self.assertEqual(identity.failed_message_count, 0)
+
+        self.time.return_value = 6120
+        flush_failed_message_counts.run()
+        identity.refresh_from_db()
+        self.assertEqual(identity.failed_message_count, 2)
+
+        # Flushing again shouldn't apply the reports again
+        flush_failed_message_counts.run()
+        identity.refresh_from_db()
+        self.assertEqual(identity.failed_message_count, 2)
+
+    def test_reports_folded_in_order(self):
+        identity = self.make_identity()
+        FailedMessageCount.objects.create(identity=identity, count=3)
+
+        self.post_report(False, identity=str(identity.id))
+        self.post_report(True, identity=str(identity.id))
+        self.post_report(False, identity=str(identity.id))
+        self.time.return_value = 6060
+        self.post_report(False, identity=str(identity.id))
+
+        self.time.return_value = 6180
+        flush_failed_message_counts.run()
+        identity.refresh_from_db()
+        self.assertEqual(identity.failed_message_count, 2)
+
+    @responses.activate
+    def test_max_failures_hook_fired_on_flush(self):
+        """
+        The hook should fire once for the identity reaching the maximum, even
+        when the failures are spread across intervals, with the count it was
+        reached at.
+        """
+        hook = Hook.objects.create(
+            user=self.user, event="identity.max_failures", target="http://example.com"
+        )
+        responses.add(responses.POST, "http://example.com", status=200)
+        identity = self.make_identity()
+        FailedMessageCount.objects.create(identity=identity, count=3)
+
+        self.post_report(False, identity=str(identity.id))
+        self.post_report(False, identity=str(identity.id))
+        self.time.return_value = 6060
+        self.post_report(False, identity=str(identity.id))
+        self.assertEqual(len(responses.calls), 0)
+
+        self.time.return_value = 6180
+        flush_failed_message_counts.run()
+
+        [call] = responses.calls
+        self.assertEqual(
+            json.loads(call.request.body),
+            {
+                "hook": hook.dict(),
+                "data": {"identity_id": str(identity.id), "failure_count": 5},
+            },
+        )
+
+    @patch("identities.tasks.fire_max_send_failures_hook")
+    def test_max_failures_reached_before_reset(self, fire):
+        """
+        The hook should fire for runs of failures that reached the maximum
+        before a successful delivery reset them, within an interval or across
+        intervals.
+        """
+        identity1 = self.make_identity()
+        FailedMessageCount.objects.create(identity=identity1, count=3)
+        identity2 = self.make_identity()
+
+        for delivered in [False, False, True, False]:
+            self.post_report(delivered, identity=str(identity1.id))
+        for delivered in [True, False, False, False, False, False]:
+            self.post_report(delivered, identity=str(identity2.id))
+        self.time.return_value = 6060
+        self.post_report(True, identity=str(identity2.id))
+
+        self.time.return_value = 6180
+        flush_failed_message_counts.run()
+
+        identity1.refresh_from_db()
+        self.assertEqual(identity1.failed_message_count, 1)
+        identity2.refresh_from_db()
+        self.assertEqual(identity2.failed_message_count, 0)
+        self.assertEqual(
+            sorted(
+                (args for args, _ in fire.call_args_list),
+                key=lambda args: args[1] != identity1.id,
+            ),
+            [(self.user, identity1.id, 5), (self.user, identity2.id, 5)],
+        )
+
+    @patch("identities.tasks.fire_max_send_failures_hook")
+    def test_several_runs_reached_max(self, fire):
+        """
+        The hook should fire for every run of failures that reached the
+        maximum, not just the longest, within an interval or across intervals.
+        """
+        identity = self.make_identity()
+
+        for delivered in "FFFFFSFFFFFSFFFFFSFFF":
+            self.post_report(delivered == "S", identity=str(identity.id))
+        self.time.return_value = 6060
+        for delivered in "FFS":
+            self.post_report(delivered == "S", identity=str(identity.id))
+
+        self.time.return_value = 6180
+        flush_failed_message_counts.run()
+
+        identity.refresh_from_db()
+        self.assertEqual(identity.failed_message_count, 0)
+        self.assertEqual(
+            [args for args, _ in fire.call_args_list], [(self.user, identity.id, 5)] * 4
+        )
+
+    @override_settings(MAX_FAILURES_RENOTIFY_INTERVAL=2)
+    @patch("identities.tasks.fire_max_send_failures_hook")
+    def test_renotify_on_flush(self, fire):
+        """
+        The hook should fire at every renotify point that each run of failures
+        passed, as it would for the reports one at a time.
+        """
+        identity = self.make_identity()
+
+        for delivered in "FSFFFFFFFSFFFFFSFF":
+            self.post_report(delivered == "S", identity=str(identity.id))
+        self.time.return_value = 6060
+        for delivered in "FFFS":
+            self.post_report(delivered == "S", identity=str(identity.id))
+
+        self.time.return_value = 6180
+        flush_failed_message_counts.run()
+
+        self.assertEqual([args[2] for args, _ in fire.call_args_list], [5, 7, 5, 5])
+
+    def test_deleted_user_skipped(self):
+        identity = self.make_identity()
+        user = User.objects.create_user("deleted")
+        buffer_delivery_report(user, identity.id, False)
+        other = self.make_identity()
+        self.post_report(False, identity=str(other.id))
+        user.delete()
+
+        self.time.return_value = 6120
+        with self.assertLogs("identities.tasks", "WARNING"):
+            flush_failed_message_counts.run()
+
+        identity.refresh_from_db()
+        self.assertEqual(identity.failed_message_count, 0)
+        other.refresh_from_db()
+        self.assertEqual(other.failed_message_count, 1)
+
+    def test_unknown_identity(self):
+        response = self.post_report(False, to_addr="+27999")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), ["No identity found for given address"])
+
+
 class TestOptInAPI(AuthenticatedAPITestCase):
     def test_create_optin_with_identity(self):
         # Setup
@@ -1626,18 +2770,843 @@ class TestHealthcheckAPI(AuthenticatedAPITestCase):
         self.assertEqual(response.data["result"]["database"], "Accessible")
 
 
-class TestMetricsAPI(AuthenticatedAPITestCase):
-    def test_metrics_read(self):
-        # Setup
-        # Execute
-        response = self.client.get("/api/metrics/", content_type="application/json")
-        # Check
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(sorted(response.data["metrics_available"]), sorted([]))
+@override_settings(HOOK_OUTBOX=True)
+class TestOutbox(AuthenticatedAPITestCase):
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        self.hook = Hook.objects.create(
+            user=self.user, event="identity.created", target="http://example.com/"
+        )
 
     @responses.activate
-    def test_post_metrics(self):
-        # Setup
+    def test_deliveries_written_to_outbox(self):
+        responses.add(responses.POST, "http://example.com/", status=200)
+
+        response = self.client.post(
+            "/api/v1/identities/",
+            json.dumps({"details": {"name": "test"}}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        identity = Identity.objects.get(id=response.data["id"])
+
+        self.assertEqual(len(responses.calls), 0)
+        [event] = OutboxEvent.objects.all()
+        self.assertEqual(event.hook, self.hook)
+        self.assertEqual(event.instance_id, str(identity.id))
+
+        dispatch_outbox.run()
+
+        self.assertFalse(OutboxEvent.objects.exists())
+        [call] = responses.calls
+        self.assertEqual(
+            json.loads(call.request.body),
+            json.loads(json.dumps(identity.serialize_hook(self.hook))),
+        )
+
+    @override_settings(HOOK_DISPATCHER=True)
+    @patch("identities.tasks.DeliverHooks.apply_async")
+    def test_dispatcher_fallback(self, apply_async):
+        """
+        With the dispatch_hooks command in use, only deliveries that it hasn't
+        picked up in time should be queued
+        """
+        for i in range(2):
+            OutboxEvent.objects.create(
+                hook=self.hook, target="http://example.com/", payload={"i": i}
+            )
+        OutboxEvent.objects.filter(payload={"i": 0}).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+
+        dispatch_outbox.run()
+
+        [(args, kwargs)] = apply_async.call_args_list
+        self.assertEqual(
+            [d["payload"] for d in kwargs["kwargs"]["deliveries"]], [{"i": 0}]
+        )
+        self.assertEqual(
+            list(OutboxEvent.objects.values_list("payload", flat=True)), [{"i": 1}]
+        )
+
+    def test_bulk_deliveries_written_to_outbox(self):
+        response = self.client.post(
+            "/api/v1/identities/bulk/",
+            json.dumps([{"details": {"name": str(i)}} for i in range(3)]),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(OutboxEvent.objects.count(), 3)
+
+    def test_rolled_back(self):
+        """
+        If the transaction that fired the hook is rolled back, nothing should
+        be delivered.
+        """
+        try:
+            with transaction.atomic():
+                Identity.objects.create(
+                    details={}, created_by=self.user, updated_by=self.user
+                )
+                self.assertEqual(OutboxEvent.objects.count(), 1)
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertFalse(OutboxEvent.objects.exists())
+
+
+@override_settings(HOOK_OUTBOX=True)
+class TestOutboxTransaction(TransactionTestCase):
+    """
+    The outbox is written in the same transaction as the change, so if the
+    outbox write fails, the change should be rolled back
+    """
+
+    def setUp(self):
+        post_save.disconnect(handle_optout, sender=Identity)
+        post_save.disconnect(handle_optin, sender=Identity)
+        self.user = User.objects.create_user("testuser")
+        token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+
+    def test_create_rolled_back(self):
+        Hook.objects.create(
+            user=self.user, event="identity.created", target="http://example.com/"
+        )
+
+        with patch.object(OutboxEvent.objects, "create", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.client.post(
+                    "/api/v1/identities/",
+                    json.dumps({"details": {"name": "test"}}),
+                    content_type="application/json",
+                )
+
+        self.assertFalse(Identity.objects.exists())
+
+    def test_bulk_create_rolled_back(self):
+        Hook.objects.create(
+            user=self.user, event="identity.created", target="http://example.com/"
+        )
+
+        with patch.object(
+            OutboxEvent.objects, "bulk_create", side_effect=DatabaseError
+        ):
+            with self.assertRaises(DatabaseError):
+                self.client.post(
+                    "/api/v1/identities/bulk/",
+                    json.dumps([{"details": {"name": str(i)}} for i in range(3)]),
+                    content_type="application/json",
+                )
+
+        self.assertFalse(Identity.objects.exists())
+        self.assertFalse(IdentityAddress.objects.exists())
+
+    def test_optout_rolled_back(self):
+        Hook.objects.create(
+            user=self.user, event="optout.requested", target="http://example.com/"
+        )
+        identity = Identity.objects.create(
+            details={"addresses": {"msisdn": {"+27123": {}}}}
+        )
+
+        with patch.object(OutboxEvent.objects, "create", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.client.post(
+                    "/api/v1/optout/",
+                    json.dumps(
+                        {
+                            "optout_type": "stop",
+                            "identity": str(identity.id),
+                            "address_type": "msisdn",
+                            "address": "+27123",
+                            "request_source": "test_source",
+                            "requestor_source_id": "1",
+                        }
+                    ),
+                    content_type="application/json",
+                )
+
+        self.assertFalse(OptOut.objects.exists())
+        identity.refresh_from_db()
+        self.assertEqual(identity.details["addresses"]["msisdn"]["+27123"], {})
+
+
+class TestBatchedDelivery(AuthenticatedAPITestCase):
+    def setUp(self):
+        super(TestBatchedDelivery, self).setUp()
+        self.hook = Hook.objects.create(
+            user=self.user, event="identity.created", target="http://example.com/"
+        )
+
+    def test_create_webhook_with_batch_size(self):
+        response = self.client.post(
+            "/api/v1/webhook/",
+            json.dumps(
+                {
+                    "target": "http://example.com/batch/",
+                    "event": "identity.created",
+                    "batch_size": 50,
+                }
+            ),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["batch_size"], 50)
+        self.assertEqual(response.data["batch_window"], 5)
+        config = HookConfig.objects.get(hook_id=response.data["id"])
+        self.assertEqual(config.batch_size, 50)
+
+    def test_webhook_defaults(self):
+        response = self.client.get("/api/v1/webhook/{}/".format(self.hook.id))
+
+        self.assertEqual(response.data["batch_size"], None)
+        self.assertEqual(response.data["batch_window"], 5)
+        self.assertFalse(HookConfig.objects.exists())
+
+    @responses.activate
+    def test_single_delivery_by_default(self):
+        responses.add(responses.POST, "http://example.com/", status=200)
+
+        Identity.objects.create(details={}, created_by=self.user, updated_by=self.user)
+
+        self.assertFalse(OutboxEvent.objects.exists())
+        [call] = responses.calls
+        self.assertIsInstance(json.loads(call.request.body), dict)
+
+    @responses.activate
+    def test_deliveries_posted_as_batch(self):
+        responses.add(responses.POST, "http://example.com/", status=200)
+        HookConfig.objects.create(hook=self.hook, batch_size=10)
+
+        identities = [
+            Identity.objects.create(
+                details={}, created_by=self.user, updated_by=self.user
+            )
+            for _ in range(3)
+        ]
+
+        self.assertEqual(len(responses.calls), 0)
+        self.assertEqual(OutboxEvent.objects.filter(batched=True).count(), 3)
+
+        deliver_hook_batch.run(self.hook.id)
+
+        self.assertFalse(OutboxEvent.objects.exists())
+        [call] = responses.calls
+        self.assertEqual(
+            json.loads(call.request.body),
+            [
+                json.loads(json.dumps(identity.serialize_hook(self.hook)))
+                for identity in identities
+            ],
+        )
+
+    @responses.activate
+    def test_batches_split_by_batch_size(self):
+        responses.add(responses.POST, "http://example.com/", status=200)
+        HookConfig.objects.create(hook=self.hook, batch_size=2)
+        for _ in range(3):
+            Identity.objects.create(
+                details={}, created_by=self.user, updated_by=self.user
+            )
+
+        deliver_hook_batch.run(self.hook.id)
+
+        self.assertEqual(
+            [len(json.loads(call.request.body)) for call in responses.calls], [2, 1]
+        )
+
+    @responses.activate
+    def test_batching_turned_off(self):
+        """
+        Deliveries still waiting when batching is turned off are delivered
+        one at a time.
+        """
+        responses.add(responses.POST, "http://example.com/", status=200)
+        config = HookConfig.objects.create(hook=self.hook, batch_size=10)
+        Identity.objects.create(details={}, created_by=self.user, updated_by=self.user)
+        config.delete()
+
+        deliver_hook_batch.run(self.hook.id)
+
+        [call] = responses.calls
+        self.assertIsInstance(json.loads(call.request.body), dict)
+
+    def test_dispatch_outbox_skips_batched(self):
+        HookConfig.objects.create(hook=self.hook, batch_size=10)
+        Identity.objects.create(details={}, created_by=self.user, updated_by=self.user)
+
+        dispatch_outbox.run()
+
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+    @patch("identities.tasks.deliver_hook_batch.apply_async")
+    def test_schedule_hook_batch(self, apply_async):
+        """
+        A batch is queued once when the batch window has passed, or straight
+        away when it is full.
+        """
+        config = HookConfig.objects.create(hook=self.hook, batch_size=3)
+
+        schedule_hook_batch(config, 1)
+        schedule_hook_batch(config, 1)
+        apply_async.assert_called_once_with(
+            kwargs={"hook_id": self.hook.id}, countdown=5
+        )
+
+        apply_async.reset_mock()
+        schedule_hook_batch(config, 1)
+        apply_async.assert_called_once_with(kwargs={"hook_id": self.hook.id})
+
+
+class TestHookPayloadModes(AuthenticatedAPITestCase):
+    def make_hook(self, event, **config):
+        hook = Hook.objects.create(
+            user=self.user, event=event, target="http://example.com/"
+        )
+        HookConfig.objects.create(hook=hook, **config)
+        return hook
+
+    def delivered_payload(self, apply_async):
+        [call] = apply_async.call_args_list
+        return call[1]["kwargs"]["payload"]
+
+    @patch("identities.tasks.DeliverHook.apply_async")
+    def test_id_only(self, apply_async):
+        hook = self.make_hook("identity.created", payload_mode="id")
+
+        identity = Identity.objects.create(
+            details={"name": "test"}, created_by=self.user, updated_by=self.user
+        )
+
+        self.assertEqual(
+            self.delivered_payload(apply_async),
+            {"hook": hook.dict(), "data": {"id": str(identity.id)}},
+        )
+
+    @patch("identities.tasks.DeliverHook.apply_async")
+    def test_fields(self, apply_async):
+        hook = self.make_hook(
+            "identity.created",
+            payload_mode="fields",
+            payload_fields=["version", "details.name", "details.missing", "created_by"],
+        )
+
+        Identity.objects.create(
+            details={"name": "test", "other": "value"},
+            created_by=self.user,
+            updated_by=self.user,
+        )
+
+        self.assertEqual(
+            self.delivered_payload(apply_async),
+            {
+                "hook": hook.dict(),
+                "data": {
+                    "version": 1,
+                    "details": {"name": "test"},
+                    "created_by": "testuser",
+                },
+            },
+        )
+
+    def test_related_objects_not_loaded(self):
+        self.make_hook("identity.created", payload_mode="id")
+        [hook] = get_hooks("identity.created", ALL_USERS)
+        identity = Identity.objects.get(id=self.make_identity().id)
+
+        with self.assertNumQueries(0):
+            identity.serialize_hook(hook)
+
+    @patch("identities.tasks.DeliverHook.apply_async")
+    def test_raw_event(self, apply_async):
+        self.make_hook("optout.requested", payload_mode="id")
+        identity = self.make_identity()
+
+        OptOut.objects.create(
+            identity=identity,
+            created_by=self.user,
+            request_source="test_source",
+            requestor_source_id=1,
+            address_type="msisdn",
+            address="+27123",
+            optout_type="stop",
+        )
+
+        self.assertEqual(
+            self.delivered_payload(apply_async), {"identity": str(identity.id)}
+        )
+
+    @patch("identities.tasks.DeliverHook.apply_async")
+    def test_full_by_default(self, apply_async):
+        hook = Hook.objects.create(
+            user=self.user, event="identity.max_failures", target="http://a.com/"
+        )
+
+        fire_max_send_failures_hook(self.user, "identity-id", 5)
+
+        self.assertEqual(
+            self.delivered_payload(apply_async),
+            {
+                "hook": hook.dict(),
+                "data": {"identity_id": "identity-id", "failure_count": 5},
+            },
+        )
+
+    def test_fields_mode_requires_fields(self):
+        response = self.client.post(
+            "/api/v1/webhook/",
+            json.dumps(
+                {
+                    "target": "http://example.com/",
+                    "event": "identity.created",
+                    "payload_mode": "fields",
+                }
+            ),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("payload_fields", response.data)
+
+
+class TestSerializeHook(AuthenticatedAPITestCase):
+    def setUp(self):
+        super(TestSerializeHook, self).setUp()
+        self.hook = Hook.objects.create(
+            user=self.user, event="identity.created", target="http://a.com/"
+        )
+        [self.hook] = get_hooks("identity.created", ALL_USERS)
+
+    def test_payload(self):
+        other = self.make_identity()
+        identity = Identity.objects.create(
+            details={"name": "test"},
+            communicate_through=other,
+            operator=other,
+            created_by=self.user,
+            updated_by=self.superuser,
+        )
+        identity = Identity.objects.get(id=identity.id)
+
+        # One query for both users, and none for the related identities
+        with self.assertNumQueries(1):
+            payload = identity.serialize_hook(self.hook)
+            identity.serialize_hook(self.hook)
+
+        self.assertEqual(
+            payload,
+            {
+                "hook": self.hook.dict(),
+                "data": {
+                    "id": str(identity.id),
+                    "version": 1,
+                    "details": {"name": "test"},
+                    "communicate_through": str(other.id),
+                    "operator": str(other.id),
+                    "created_at": identity.created_at.isoformat(),
+                    "created_by": "testuser",
+                    "updated_at": identity.updated_at.isoformat(),
+                    "updated_by": "testsu",
+                },
+            },
+        )
+
+    def test_no_related_objects(self):
+        identity = Identity.objects.get(id=self.make_identity().id)
+
+        with self.assertNumQueries(0):
+            data = identity.serialize_hook(self.hook)["data"]
+
+        self.assertEqual(data["communicate_through"], "None")
+        self.assertEqual(data["operator"], "None")
+        self.assertEqual(data["created_by"], None)
+
+    @patch("identities.tasks.DeliverHooks.apply_async")
+    def test_users_loaded_once_for_bulk(self, apply_async):
+        for _ in range(3):
+            Identity.objects.create(
+                details={}, created_by=self.user, updated_by=self.user
+            )
+        identities = list(Identity.objects.all())
+
+        with self.assertNumQueries(1):
+            deliver_hooks_in_batches("identity.created", identities)
+
+        [call] = apply_async.call_args_list
+        self.assertEqual(
+            [
+                d["payload"]["data"]["created_by"]
+                for d in call[1]["kwargs"]["deliveries"]
+            ],
+            ["testuser"] * 3,
+        )
+
+
+class TestHookCache(AuthenticatedAPITestCase):
+    def fire(self):
+        fire_max_send_failures_hook(self.user, "identity-id", 5)
+
+    @patch("identities.tasks.DeliverHook.apply_async")
+    def test_cached(self, apply_async):
+        Hook.objects.create(
+            user=self.user, event="identity.max_failures", target="http://a.com/"
+        )
+        self.fire()
+
+        with self.assertNumQueries(0):
+            self.fire()
+        self.assertEqual(apply_async.call_count, 2)
+
+    @patch("identities.tasks.DeliverHook.apply_async")
+    def test_created_event_cached(self, apply_async):
+        Hook.objects.create(
+            user=self.user, event="identity.created", target="http://a.com/"
+        )
+        Identity.objects.create(details={}, created_by=self.user, updated_by=self.user)
+
+        with CaptureQueriesContext(connection) as queries:
+            Identity.objects.create(
+                details={}, created_by=self.user, updated_by=self.user
+            )
+        self.assertFalse(
+            [q for q in queries.captured_queries if "rest_hooks_hook" in q["sql"]]
+        )
+        self.assertEqual(apply_async.call_count, 2)
+
+    @patch("identities.tasks.DeliverHook.apply_async")
+    def test_invalidated_by_api(self, apply_async):
+        self.fire()
+        response = self.client.post(
+            "/api/v1/webhook/",
+            json.dumps({"target": "http://a.com/", "event": "identity.max_failures"}),
+            content_type="application/json",
+        )
+        self.fire()
+        self.assertEqual(apply_async.call_count, 1)
+
+        self.client.patch(
+            "/api/v1/webhook/{}/".format(response.data["id"]),
+            json.dumps({"batch_size": 10}),
+            content_type="application/json",
+        )
+        [hook] = get_hooks("identity.max_failures", self.user)
+        self.assertEqual(hook.config.batch_size, 10)
+
+        self.client.delete("/api/v1/webhook/{}/".format(response.data["id"]))
+        self.fire()
+        self.assertEqual(apply_async.call_count, 1)
+
+    def test_per_user(self):
+        other = User.objects.create_user("other")
+        hook = Hook.objects.create(
+            user=self.user, event="identity.max_failures", target="http://a.com/"
+        )
+
+        self.assertEqual(get_hooks("identity.max_failures", self.user), [hook])
+        self.assertEqual(get_hooks("identity.max_failures", other.id), [])
+        self.assertEqual(get_hooks("identity.max_failures", ALL_USERS), [hook])
+        self.assertEqual(get_hooks("identity.max_failures", None), [])
+
+    @patch("identities.tasks.DeliverHook.apply_async")
+    def test_raw_event_without_user(self, apply_async):
+        Hook.objects.create(
+            user=self.user, event="identity.max_failures", target="http://a.com/"
+        )
+        raw_hook_event.send(
+            sender=None,
+            event_name="identity.max_failures",
+            payload={"identity_id": "1"},
+            user=None,
+        )
+        apply_async.assert_not_called()
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append((self.path, json.loads(body.decode("utf-8"))))
+        if self.path == "/slow/":
+            # Held until a delivery to another path is received
+            self.server.release.wait(5)
+        else:
+            self.server.release.set()
+        statuses = {"/fail/": 500, "/reject/": 400}
+        self.send_response(statuses.get(self.path, 200))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class HookServerMixin(object):
+    def start_hook_server(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        self.server.received = []
+        self.server.release = threading.Event()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(get_session().close)
+        self.target = "http://127.0.0.1:%s/hook/" % self.server.server_port
+
+
+class TestDeliverHook(HookServerMixin, TestCase):
+    def setUp(self):
+        self.start_hook_server()
+        cache.clear()
+
+    def get_metric(self, name):
+        return REGISTRY.get_sample_value(name, {"host": "127.0.0.1"}) or 0
+
+    def test_connections_reused(self):
+        """
+        Deliveries to the same target should reuse the same connection
+        """
+        requests_before = self.get_metric("hook_delivery_requests_total")
+        connections_before = self.get_metric("hook_delivery_connections_total")
+
+        for i in range(3):
+            DeliverHook().run(self.target, {"i": i})
+
+        self.assertEqual(
+            self.get_metric("hook_delivery_requests_total") - requests_before, 3
+        )
+        self.assertEqual(
+            self.get_metric("hook_delivery_connections_total") - connections_before, 1
+        )
+
+    @override_settings(HOOK_CONNECT_TIMEOUT=1, HOOK_READ_TIMEOUT=2)
+    def test_timeouts(self):
+        with patch.object(get_session(), "post") as post:
+            DeliverHook().run("http://example.com/", {})
+
+        [(args, kwargs)] = post.call_args_list
+        self.assertEqual(kwargs["timeout"], (1, 2))
+
+    @override_settings(HOOK_MAX_RETRIES=2)
+    @responses.activate
+    def test_retried_then_dead_lettered(self):
+        user = User.objects.create_user("test")
+        hook = Hook.objects.create(
+            user=user, event="identity.created", target="http://example.com/"
+        )
+        responses.add(responses.POST, "http://example.com/", status=500)
+
+        DeliverHook().run("http://example.com/", {"foo": "bar"}, "1", hook.id)
+
+        self.assertEqual(len(responses.calls), 3)
+        [dead_letter] = HookDeadLetter.objects.all()
+        self.assertEqual(dead_letter.hook, hook)
+        self.assertEqual(dead_letter.target, "http://example.com/")
+        self.assertEqual(dead_letter.payload, {"foo": "bar"})
+        self.assertEqual(dead_letter.instance_id, "1")
+        self.assertEqual(dead_letter.attempts, 3)
+
+    @responses.activate
+    def test_retried_until_success(self):
+        responses.add(responses.POST, "http://example.com/", status=503)
+        responses.add(responses.POST, "http://example.com/", status=200)
+
+        DeliverHook().run("http://example.com/", {})
+
+        self.assertEqual(len(responses.calls), 2)
+        self.assertFalse(HookDeadLetter.objects.exists())
+
+    @responses.activate
+    def test_client_error_not_retried(self):
+        responses.add(responses.POST, "http://example.com/", status=400)
+
+        DeliverHook().run("http://example.com/", {})
+
+        self.assertEqual(len(responses.calls), 1)
+        [dead_letter] = HookDeadLetter.objects.all()
+        self.assertEqual(dead_letter.attempts, 1)
+
+    @override_settings(HOOK_MAX_RETRIES=0, HOOK_CIRCUIT_FAILURE_THRESHOLD=2)
+    @responses.activate
+    def test_circuit_breaker(self):
+        """
+        Once a target has failed enough times, deliveries to it should be
+        paused, without affecting other targets.
+        """
+        responses.add(responses.POST, "http://down.example.com/", status=500)
+        responses.add(responses.POST, "http://example.com/", status=200)
+
+        for i in range(3):
+            DeliverHook().run("http://down.example.com/", {})
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(
+            HookDeadLetter.objects.filter(error="Circuit open for target").count(), 1
+        )
+
+        DeliverHook().run("http://example.com/", {})
+        self.assertEqual(len(responses.calls), 3)
+
+        # After the reset timeout, a delivery is let through, and failing
+        # opens the circuit again
+        cache.delete(circuit_key("http://down.example.com/", "open"))
+        DeliverHook().run("http://down.example.com/", {})
+        DeliverHook().run("http://down.example.com/", {})
+        self.assertEqual(len(responses.calls), 4)
+
+    def test_session_per_process(self):
+        session = get_session()
+        self.assertIs(get_session(), session)
+
+        with patch("identities.tasks.os.getpid", return_value=-1):
+            self.assertIsNot(get_session(), session)
+
+
+@override_settings(HOOK_OUTBOX=True, HOOK_MAX_RETRIES=0)
+class TestDispatchHooksCommand(HookServerMixin, TransactionTestCase):
+    def setUp(self):
+        self.start_hook_server()
+        cache.clear()
+        user = User.objects.create_user("test")
+        self.hook = Hook.objects.create(
+            user=user, event="identity.created", target=self.target
+        )
+
+    def add_event(self, path, payload):
+        OutboxEvent.objects.create(
+            hook=self.hook, target=self.target.replace("/hook/", path), payload=payload
+        )
+
+    def test_deliveries(self):
+        for i in range(5):
+            self.add_event("/hook/", {"i": i})
+        self.add_event("/reject/", {"i": "rejected"})
+        self.add_event("/fail/", {"i": "failed"})
+
+        call_command("dispatch_hooks", "--once")
+
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(
+            sorted(
+                payload["i"]
+                for path, payload in self.server.received
+                if path == "/hook/"
+            ),
+            list(range(5)),
+        )
+        self.assertEqual(
+            sorted(HookDeadLetter.objects.values_list("target", "attempts")),
+            [
+                (self.target.replace("/hook/", "/fail/"), 1),
+                (self.target.replace("/hook/", "/reject/"), 1),
+            ],
+        )
+
+    @override_settings(
+        HOOK_DISPATCHER_CONCURRENCY=2, HOOK_DISPATCHER_TARGET_CONCURRENCY=1
+    )
+    def test_slow_target(self):
+        """
+        Deliveries waiting for a slow target shouldn't stop deliveries to
+        other targets
+        """
+        for i in range(3):
+            self.add_event("/slow/", {"i": i})
+        for i in range(2):
+            self.add_event("/hook/", {"i": i})
+
+        call_command("dispatch_hooks", "--once")
+
+        paths = [path for path, payload in self.server.received]
+        self.assertIn("/hook/", paths[:2])
+        self.assertEqual(sorted(paths), ["/hook/"] * 2 + ["/slow/"] * 3)
+
+    def test_circuit_breaker_off_event_loop(self):
+        threads = []
+
+        def circuit_allows(target):
+            threads.append(threading.current_thread())
+            return True
+
+        self.add_event("/hook/", {"i": 1})
+        with patch(
+            "identities.management.commands.dispatch_hooks.circuit_allows",
+            circuit_allows,
+        ):
+            call_command("dispatch_hooks", "--once")
+
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_claims_leased(self):
+        """
+        Claimed deliveries stay in the outbox, but can't be claimed by other
+        dispatchers, or queued by dispatch_outbox, until the lease expires
+        """
+        self.add_event("/hook/", {"i": 1})
+        dispatcher = Dispatcher(10, 10, 1)
+        [event] = dispatcher.claim(10, [], [])
+        event.refresh_from_db()
+        self.assertEqual(event.claimed_by, dispatcher.name)
+
+        other = Dispatcher(10, 10, 1)
+        other.name = "other"
+        self.assertEqual(other.claim(10, [], []), [])
+        with patch("identities.tasks.DeliverHooks.apply_async") as apply_async:
+            dispatch_outbox.run()
+        apply_async.assert_not_called()
+
+        with override_settings(HOOK_DISPATCHER_LEASE_TIMEOUT=0):
+            [expired] = other.claim(10, [], [])
+        self.assertEqual(expired.id, event.id)
+
+        # Only the dispatcher holding the lease removes the event
+        dispatcher.claim(10, [], [event.id])
+        self.assertTrue(OutboxEvent.objects.filter(id=event.id).exists())
+        other.claim(10, [], [event.id])
+        self.assertFalse(OutboxEvent.objects.filter(id=event.id).exists())
+
+    def test_failed_handoff_left_in_outbox(self):
+        self.add_event("/hook/", {"i": 1})
+        self.add_event("/reject/", {"i": "rejected"})
+
+        with patch(
+            "identities.management.commands.dispatch_hooks.dead_letter",
+            side_effect=Exception("Database unavailable"),
+        ):
+            call_command("dispatch_hooks", "--once")
+
+        [event] = OutboxEvent.objects.all()
+        self.assertEqual(event.target, self.target.replace("/hook/", "/reject/"))
+        self.assertIsNotNone(event.claimed_at)
+
+    @override_settings(HOOK_OUTBOX=False)
+    def test_outbox_disabled(self):
+        with self.assertRaises(CommandError):
+            call_command("dispatch_hooks", "--once")
+
+
+class TestMetricsAPI(AuthenticatedAPITestCase):
+    def test_metrics_read(self):
+        # Setup
+        # Execute
+        response = self.client.get("/api/metrics/", content_type="application/json")
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(response.data["metrics_available"]), sorted([]))
+
+    @responses.activate
+    def test_post_metrics(self):
+        # Setup
         # deactivate Testsession for this test
         self.session = None
         responses.add(
@@ -1657,6 +3626,10 @@ class TestMetricsAPI(AuthenticatedAPITestCase):
 class CachedTokenAuthenticationTests(TestCase):
     url = reverse("identity-list")
 
+    def setUp(self):
+        caches["locmem"].clear()
+        cache.clear()
+
     def test_auth_required(self):
         """
         Ensure that the view we're testing actually requires token auth
@@ -1682,3 +3655,114 @@ class CachedTokenAuthenticationTests(TestCase):
                 self.url, HTTP_AUTHORIZATION="Token {}".format(token.key)
             )
             self.assertEqual(r.status_code, status.HTTP_200_OK)
+
+    def get(self, key):
+        return self.client.get(self.url, HTTP_AUTHORIZATION="Token {}".format(key))
+
+    def test_shared_cache(self):
+        """
+        Tokens cached by another process are used from the default cache
+        """
+        token = Token.objects.create(user=User.objects.create_user("test"))
+        self.get(token.key)
+        caches["locmem"].clear()
+
+        with self.assertNumQueries(1):
+            r = self.get(token.key)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+
+    def test_invalid_token_cached(self):
+        r = self.get("invalid")
+        self.assertEqual(r.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        with self.assertNumQueries(0):
+            r = self.get("invalid")
+        self.assertEqual(r.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(r.data["detail"], "Invalid token.")
+
+    def test_deleted_token(self):
+        token = Token.objects.create(user=User.objects.create_user("test"))
+        self.assertEqual(self.get(token.key).status_code, status.HTTP_200_OK)
+
+        token.delete()
+
+        self.assertEqual(self.get(token.key).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user(self):
+        user = User.objects.create_user("test")
+        token = Token.objects.create(user=user)
+        self.assertEqual(self.get(token.key).status_code, status.HTTP_200_OK)
+
+        user.is_active = False
+        user.save()
+
+        r = self.get(token.key)
+        self.assertEqual(r.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(r.data["detail"], "User inactive or deleted.")
+
+
+class CachedBasicAuthenticationTests(TestCase):
+    url = reverse("identity-list")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user("test", password="secret")
+
+    def get(self, username="test", password="secret"):
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Basic {}".format(
+                base64.b64encode(
+                    "{}:{}".format(username, password).encode("utf-8")
+                ).decode("ascii")
+            )
+        )
+        return self.client.get(self.url)
+
+    def test_password_checked_once(self):
+        with patch(
+            "django.contrib.auth.base_user.check_password", wraps=check_password
+        ) as check:
+            self.assertEqual(self.get().status_code, status.HTTP_200_OK)
+            self.assertEqual(self.get().status_code, status.HTTP_200_OK)
+
+        self.assertEqual(check.call_count, 1)
+
+    def test_wrong_password(self):
+        self.assertEqual(self.get().status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            self.get(password="wrong").status_code, status.HTTP_401_UNAUTHORIZED
+        )
+
+    def test_password_changed(self):
+        self.assertEqual(self.get().status_code, status.HTTP_200_OK)
+
+        self.user.set_password("changed")
+        self.user.save()
+
+        self.assertEqual(self.get().status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.get(password="changed").status_code, status.HTTP_200_OK)
+
+    def test_deactivated_user(self):
+        self.assertEqual(self.get().status_code, status.HTTP_200_OK)
+
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertEqual(self.get().status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_benchmark_command(self):
+        stdout = StringIO()
+
+        call_command("benchmark_auth", requests=1, stdout=stdout)
+
+        self.assertEqual(
+            [line.split(":")[0] for line in stdout.getvalue().splitlines()],
+            [
+                "BasicAuthentication",
+                "CachedBasicAuthentication",
+                "TokenAuthentication",
+                "CachedTokenAuthentication",
+            ],
+        )
+        self.assertFalse(User.objects.filter(username="benchmark_auth").exists())
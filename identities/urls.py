@@ -19,10 +19,22 @@ urlpatterns = [
         r"^api/v1/identities/search/$",
         papertrail.debug(sample=0.1)(views.IdentitySearchList.as_view()),
     ),
+    url(
+        r"^api/v1/identities/search/bulk/$",
+        papertrail.debug(sample=0.1)(views.BulkAddressSearch.as_view()),
+    ),
     url(
         r"^api/v1/identities/message_count/$",
         papertrail.debug(sample=0.1)(views.UpdateFailedMessageCount.as_view()),
     ),
+    url(
+        r"^api/v1/identities/message_count/bulk/$",
+        papertrail.debug(sample=0.1)(views.BulkUpdateFailedMessageCount.as_view()),
+    ),
+    url(
+        r"^api/v1/identities/addresses/$",
+        papertrail.debug(sample=0.1)(views.BulkIdentityAddresses.as_view()),
+    ),
     url(
         r"^api/v1/identities/(?P<identity_id>.+)/addresses/(?P<address_type>.+)$",  # noqa
         papertrail.debug(sample=0.1)(views.IdentityAddresses.as_view()),
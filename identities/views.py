@@ -1,29 +1,47 @@
+from collections import OrderedDict, defaultdict
+
 import django_filters
 from django.conf import settings
 from django.contrib.auth.models import Group, User
 from django.core.exceptions import FieldError
-from django.db.models.expressions import F
+from django.db import transaction
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django_filters import rest_framework as filters
 from rest_framework import generics, mixins, status, viewsets
 from rest_framework.authtoken.models import Token
+from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import CursorPagination, LimitOffsetPagination
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_hooks.models import Hook
-from rest_hooks.signals import raw_hook_event
 
 from .models import DetailKey, Identity, OptIn, OptOut
 from .serializers import (
     AddressSerializer,
+    BulkAddressSearchSerializer,
+    BulkIdentityAddressesSerializer,
     CreateUserSerializer,
+    DeliveryReportSerializer,
     GroupSerializer,
     HookSerializer,
     IdentitySerializer,
     OptInSerializer,
     OptOutSerializer,
     UserSerializer,
+    validate_batch_size,
+)
+from .tasks import (
+    DELIVERED_REPORT,
+    FAILED_REPORT,
+    NO_DELIVERY_REPORTS,
+    apply_delivery_reports,
+    buffer_delivery_report,
+    fire_max_send_failures_hook,
+    fold_delivery_reports,
+    reached_max_failures,
 )
 
 
@@ -116,12 +134,40 @@ class IdentityViewSet(viewsets.ModelViewSet):
     filterset_class = IdentityFilter
     pagination_class = CreatedAtCursorPagination
 
+    @transaction.atomic
     def perform_create(self, serializer):
         serializer.save(created_by=self.request.user, updated_by=self.request.user)
 
+    @transaction.atomic
     def perform_update(self, serializer):
         serializer.save(updated_by=self.request.user)
 
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """
+        Creates a list of identities in a single transaction. If any of them
+        are invalid, none are created, and the errors for each are returned.
+        """
+        if isinstance(request.data, list):
+            validate_batch_size(request.data)
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+def is_details_key_filter(filter):
+    """
+    Whether the filter is an exact match on a top level key of the details,
+    e.g. "details__personnel_code".
+    """
+    if not filter.startswith("details__"):
+        return False
+    key = filter.replace("details__", "", 1)
+    if "__" in key:
+        return False
+    return Identity._meta.get_field("details").get_lookup(key) is None
+
 
 class IdentitySearchList(generics.ListAPIView):
     permission_classes = (IsAuthenticated,)
@@ -148,9 +194,12 @@ class IdentitySearchList(generics.ListAPIView):
 
         # variable that stores criteria to filter identities by
         filter_criteria = {}
-        # variable that stores a list of addresses that should be active
-        # if the special filter is passed in
-        exclude_if_address_inactive = []
+        # variable that stores the (address_type, address) pairs to filter
+        # identities by
+        address_criteria = []
+        # variable that stores the top level details keys to filter identities
+        # by, so that they can be matched using the GIN index on details
+        details_criteria = {}
 
         # Determine from param "include_inactive" whether inactive identities
         # should be included in the search results
@@ -173,53 +222,71 @@ class IdentitySearchList(generics.ListAPIView):
                 # Don't add the cursor to the filter_criteria
                 pass
             elif filter.startswith("details__addresses__"):
-                # Edit the query_param to evaluate the key instead of the value
-                # and add it to the filter_criteria
-                filter_criteria[filter + "__has_key"] = self.request.query_params[
-                    filter
-                ]
-
-                # Add the address to the list of addresses that should not
-                # be inactive (tuple e.g ("msisdn", "+27123"))
-                if include_inactive is False:
-                    exclude_if_address_inactive.append(
-                        (
-                            filter.replace("details__addresses__", ""),
-                            self.request.query_params[filter],
-                        )
+                # Look the address up in the IdentityAddress table
+                address_criteria.append(
+                    (
+                        filter.replace("details__addresses__", ""),
+                        self.request.query_params[filter],
                     )
+                )
             else:
                 # Add the normal params to the filter criteria
                 filter_criteria[filter] = self.request.query_params[filter]
+                if is_details_key_filter(filter):
+                    key = filter.replace("details__", "", 1)
+                    details_criteria[key] = self.request.query_params[filter]
 
         identities = Identity.objects.filter(**filter_criteria)
-
-        if include_inactive is False:
-            # Check through all the identities and exclude ones where the
-            # addresses are inactive
-            for identity in identities:
-                for param in exclude_if_address_inactive:
-                    q_key = identity.details["addresses"][param[0]][param[1]]
-                    if "inactive" in q_key and q_key["inactive"] in [
-                        True,
-                        "True",
-                        "true",
-                    ]:  # noqa
-                        identities = identities.exclude(id=identity.id)
+        if details_criteria:
+            # A containment query can use the index, while the key lookups in
+            # filter_criteria still decide the exact match
+            identities = identities.filter(details__contains=details_criteria)
+        for address_type, address in address_criteria:
+            identities = identities.filter_by_addr(
+                address_type, address, include_inactive=include_inactive
+            )
 
         return identities
 
 
-def fire_max_send_failures_hook(user, identity):
-    raw_hook_event.send(
-        sender=None,
-        event_name="identity.max_failures",
-        payload={
-            "identity_id": str(identity.id),
-            "failure_count": identity.failed_message_count,
-        },
-        user=user,
-    )
+class BulkAddressSearch(APIView):
+    """ Finds the identities for a list of addresses, which can be of mixed
+        types, in one request. Uses a single query per address type.
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = BulkAddressSearchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        lookups = serializer.validated_data["addresses"]
+        include_inactive = serializer.validated_data["include_inactive"]
+
+        addresses_by_type = defaultdict(set)
+        for lookup in lookups:
+            addresses_by_type[lookup["address_type"]].add(lookup["address"])
+
+        found = defaultdict(list)
+        for address_type, addresses in addresses_by_type.items():
+            identities = (
+                Identity.objects.filter_by_addrs(
+                    address_type, addresses, include_inactive=include_inactive
+                )
+                .order_by("id")
+                .values_list("addresses__address", "id")
+            )
+            for address, identity_id in identities:
+                found[(address_type, address)].append(str(identity_id))
+
+        results = [
+            {
+                "address_type": lookup["address_type"],
+                "address": lookup["address"],
+                "identities": found[(lookup["address_type"], lookup["address"])],
+            }
+            for lookup in lookups
+        ]
+        return Response({"results": results}, status=status.HTTP_200_OK)
 
 
 class UpdateFailedMessageCount(APIView):
@@ -236,39 +303,88 @@ class UpdateFailedMessageCount(APIView):
         except KeyError:
             raise ValidationError('"data" must be supplied')
         if data.get("identity", None) is not None and data["identity"] != "":
-            identity = Identity.objects.get(pk=data["identity"])
+            target = {"identity_id": data["identity"]}
+            not_found = "No identity found for given id"
         elif data.get("to_addr", None) is not None and data["to_addr"] != "":
-            identities = Identity.objects.filter(
-                details__addresses__msisdn__has_key=data["to_addr"]
-            ).order_by("id")
-            if len(identities) > 0:
-                identity = identities[0]
-            else:
-                raise ValidationError("No identity found for given address")
+            target = {"msisdn": data["to_addr"]}
+            not_found = "No identity found for given address"
         else:
             raise ValidationError(
                 '"data" must contain either "identity" or "to_addr" keys'
             )
 
+        if settings.FAILED_MESSAGE_COUNT_FLUSH_INTERVAL:
+            # Only look the identity up here, and leave the write to the
+            # flush_failed_message_counts task
+            identity_id = Identity.objects.get_identity_id(**target)
+            if identity_id is None:
+                raise ValidationError(not_found)
+            buffer_delivery_report(request.user, identity_id, data["delivered"])
+            return Response(status=status.HTTP_200_OK)
+
         if data["delivered"]:
-            if identity.failed_message_count:
-                identity.failed_message_count = 0
-                identity.save(update_fields=["failed_message_count"])
+            result = Identity.objects.reset_failed_message_count(**target)
         else:
-            if identity.failed_message_count is None:
-                identity.failed_message_count = 1
-                identity.save(update_fields=["failed_message_count"])
-            else:
-                identity.failed_message_count = F("failed_message_count") + 1
-                identity.save(update_fields=["failed_message_count"])
-                identity.refresh_from_db()
+            result = Identity.objects.increment_failed_message_count(**target)
+        if result is None:
+            raise ValidationError(not_found)
+        identity_id, failed_message_count = result
 
-        if identity.failed_message_count >= settings.MAX_CONSECUTIVE_SEND_FAILURES:
-            fire_max_send_failures_hook(request.user, identity)
+        previous_count = 0 if data["delivered"] else failed_message_count - 1
+        if reached_max_failures(previous_count, failed_message_count):
+            fire_max_send_failures_hook(request.user, identity_id, failed_message_count)
 
         return Response(status=status.HTTP_200_OK)
 
 
+class BulkUpdateFailedMessageCount(APIView):
+    """ Applies a batch of delivery reports, each for an identity or to_addr,
+        to the failed message counts in order. The identity.max_failures hook
+        is fired for identities that reach the maximum failures in the batch.
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        if isinstance(request.data, list):
+            validate_batch_size(request.data)
+        serializer = DeliveryReportSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        reports = serializer.validated_data
+
+        to_addrs = set(r["to_addr"] for r in reports if not r.get("identity"))
+        addr_identities = dict(
+            Identity.objects.filter_by_addrs("msisdn", to_addrs)
+            .order_by("addresses__address", "id")
+            .distinct("addresses__address")
+            .values_list("addresses__address", "id")
+        )
+
+        # Fold the reports for each identity, in order
+        counts = OrderedDict()
+        identity_ids = []
+        for report in reports:
+            identity_id = report.get("identity") or addr_identities.get(
+                report["to_addr"]
+            )
+            identity_ids.append(identity_id)
+            if identity_id is None:
+                continue
+            counts[identity_id] = fold_delivery_reports(
+                counts.get(identity_id, NO_DELIVERY_REPORTS),
+                DELIVERED_REPORT if report["delivered"] else FAILED_REPORT,
+            )
+
+        found = apply_delivery_reports(counts, dict.fromkeys(counts, request.user))
+        unresolved = [
+            str(report["identity"]) if report.get("identity") else report["to_addr"]
+            for report, identity_id in zip(reports, identity_ids)
+            if identity_id not in found
+        ]
+
+        return Response({"unresolved": unresolved}, status=status.HTTP_200_OK)
+
+
 class Address(object):
     def __init__(self, address):
         self.address = address
@@ -302,6 +418,40 @@ class IdentityAddresses(generics.ListAPIView):
         return [Address(addr) for addr in addresses]
 
 
+class BulkIdentityAddresses(APIView):
+    """ Returns the addresses of a given type for a list of identities, using
+        the same rules as IdentityAddresses, from a single query.
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = BulkIdentityAddressesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        identities = Identity.objects.filter(id__in=data["identities"])
+        if data["use_communicate_through"]:
+            identities = identities.select_related("communicate_through")
+        identities = {identity.id: identity for identity in identities}
+
+        results = []
+        for identity_id in data["identities"]:
+            identity = identities.get(identity_id)
+            addresses = []
+            if identity is not None:
+                if (
+                    data["use_communicate_through"]
+                    and identity.communicate_through is not None
+                ):
+                    identity = identity.communicate_through
+                addresses = identity.get_addresses_list(
+                    data["address_type"], data["default"]
+                )
+            results.append({"identity": str(identity_id), "addresses": addresses})
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+
 class OptInViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     """ API endpoint that allows opt-ins to be created.
     """
@@ -310,6 +460,7 @@ class OptInViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     queryset = OptIn.objects.all()
     serializer_class = OptInSerializer
 
+    @transaction.atomic
     def perform_create(self, serializer):
         data = serializer.validated_data
         if "identity" not in data or data["identity"] is None:
@@ -334,6 +485,7 @@ class OptOutViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     queryset = OptOut.objects.all()
     serializer_class = OptOutSerializer
 
+    @transaction.atomic
     def perform_create(self, serializer):
         data = serializer.validated_data
         if "identity" not in data or data["identity"] is None:
@@ -367,7 +519,7 @@ class HookViewSet(viewsets.ModelViewSet):
     """
 
     permission_classes = (IsAuthenticated,)
-    queryset = Hook.objects.all()
+    queryset = Hook.objects.select_related("config")
     serializer_class = HookSerializer
 
     def perform_create(self, serializer):
@@ -430,8 +582,13 @@ class DetailKeyView(APIView):
 
     permission_classes = (IsAuthenticated,)
 
+    @method_decorator(
+        condition(
+            etag_func=lambda request, *args, **kwargs: DetailKey.objects.generation()
+        )
+    )
     def get(self, request, *args, **kwargs):
         status = 200
-        key_names = DetailKey.objects.values_list("key_name", flat=True)
+        key_names = DetailKey.objects.key_names(DetailKey.objects.generation())
         resp = {"key_names": key_names}
         return Response(resp, status=status)
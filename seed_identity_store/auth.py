@@ -1,16 +1,97 @@
-from functools import partial
+import hashlib
+import hmac
+import uuid
 
-from django.core.cache import caches
-from rest_framework.authentication import TokenAuthentication
+from django.conf import settings
+from django.core.cache import cache, caches
+from rest_framework.authentication import BasicAuthentication, TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 
 locmem_cache = caches["locmem"]
 
 
+def token_cache_key(key):
+    # Tokens from requests can be any string, so they're hashed to make a
+    # valid cache key
+    return "authtoken:{}".format(hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+
+def invalidate_cached_token(key):
+    """
+    Removes the token from the default cache, and from this process' cache.
+    Other processes keep their copy for up to TOKEN_CACHE_LOCAL_TIMEOUT
+    seconds.
+    """
+    cache_key = token_cache_key(key)
+    locmem_cache.delete(cache_key)
+    cache.delete(cache_key)
+
+
 class CachedTokenAuthentication(TokenAuthentication):
     def authenticate_credentials(self, key):
         """
-        Does a cached lookup for a user for the given token
+        Does a cached lookup for a user for the given token, first in this
+        process' cache, then in the default cache. Invalid tokens are cached
+        too, so that repeated requests with them don't reach the database.
+        """
+        cache_key = token_cache_key(key)
+        result = locmem_cache.get(cache_key)
+        if result is None:
+            result = cache.get(cache_key)
+            if result is None:
+                try:
+                    result = super().authenticate_credentials(key)
+                    timeout = settings.TOKEN_CACHE_TIMEOUT
+                except AuthenticationFailed as e:
+                    result = str(e.detail)
+                    timeout = settings.TOKEN_CACHE_INVALID_TIMEOUT
+                cache.set(cache_key, result, timeout)
+            locmem_cache.set(cache_key, result, settings.TOKEN_CACHE_LOCAL_TIMEOUT)
+        # Invalid tokens are cached as the error message
+        if isinstance(result, str):
+            raise AuthenticationFailed(result)
+        return result
+
+
+def credentials_generation_key(username):
+    return "basicauth:generation:{}".format(
+        hashlib.sha256(username.encode("utf-8")).hexdigest()
+    )
+
+
+def invalidate_cached_credentials(username):
+    """
+    Invalidates the cached basic auth credentials of the user, in all
+    processes.
+    """
+    cache.delete(credentials_generation_key(username))
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+    def authenticate_credentials(self, userid, password, request=None):
+        """
+        Caches successful logins in the default cache, so that the password
+        hash, which is deliberately slow, is only checked once every
+        BASIC_AUTH_CACHE_TIMEOUT seconds. The credentials are cached under an
+        HMAC of them, and only for the current generation of the user, which
+        changes whenever the user is saved, e.g. to change their password.
         """
-        return locmem_cache.get_or_set(
-            "authtoken:{}".format(key), partial(super().authenticate_credentials, key)
+        cache_key = "basicauth:{}".format(
+            hmac.new(
+                settings.SECRET_KEY.encode("utf-8"),
+                "{}:{}".format(userid, password).encode("utf-8"),
+                hashlib.sha256,
+            ).hexdigest()
+        )
+        # Fetched before the password is checked, so that a change to the user
+        # while it is being checked stops this login from being used
+        generation = cache.get_or_set(
+            credentials_generation_key(userid), uuid.uuid4().hex, None
         )
+        cached = cache.get(cache_key)
+        if cached is not None and cached[1] == generation:
+            return (cached[0], None)
+
+        user, auth = super().authenticate_credentials(userid, password, request)
+        cache.set(cache_key, (user, generation), settings.BASIC_AUTH_CACHE_TIMEOUT)
+        return (user, auth)
@@ -4,9 +4,12 @@ import os
 
 import celery
 import raven
+from celery.signals import worker_init
 from django.conf import settings
 from raven.contrib.celery import register_logger_signal, register_signal
 
+from seed_identity_store.metrics import start_metrics_server
+
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "seed_identity_store.settings")
 
@@ -28,6 +31,11 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
 
+@worker_init.connect
+def start_worker_metrics_server(**kwargs):
+    start_metrics_server()
+
+
 @app.task(bind=True)
 def debug_task(self):
     print("Request: {0!r}".format(self.request))
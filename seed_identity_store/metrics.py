@@ -0,0 +1,26 @@
+import os
+
+from django.conf import settings
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    multiprocess,
+    start_http_server,
+)
+
+
+def start_metrics_server():
+    """
+    Serves the metrics of this process on METRICS_PORT, if it is set, for the
+    processes that don't serve the API's /metrics. If the
+    prometheus_multiproc_dir environment variable is set, the metrics of all
+    the processes sharing that directory are served instead, which is needed
+    for the metrics of forked Celery worker processes.
+    """
+    if not settings.METRICS_PORT:
+        return
+    registry = REGISTRY
+    if "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    start_http_server(settings.METRICS_PORT, registry=registry)
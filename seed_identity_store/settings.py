@@ -131,18 +131,32 @@ RAVEN_CONFIG = {
     "dsn": os.environ.get("IDENTITIES_SENTRY_DSN", None)
 }
 
+# If set, the Celery workers and the dispatch_hooks command serve their
+# Prometheus metrics on this port, as they don't serve /metrics
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
 # REST Framework conf defaults
 REST_FRAMEWORK = {
     "PAGE_SIZE": 1000,
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.CursorPagination",
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework.authentication.BasicAuthentication",
+        "seed_identity_store.auth.CachedBasicAuthentication",
         "seed_identity_store.auth.CachedTokenAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
     "DEFAULT_FILTER_BACKENDS": ("django_filters.rest_framework.DjangoFilterBackend",),
 }
 
+# The number of seconds that token lookups are cached for in the default cache,
+# and in each process. Invalid tokens are cached for
+# TOKEN_CACHE_INVALID_TIMEOUT seconds.
+TOKEN_CACHE_TIMEOUT = int(os.environ.get("TOKEN_CACHE_TIMEOUT", 300))
+TOKEN_CACHE_LOCAL_TIMEOUT = int(os.environ.get("TOKEN_CACHE_LOCAL_TIMEOUT", 10))
+TOKEN_CACHE_INVALID_TIMEOUT = int(os.environ.get("TOKEN_CACHE_INVALID_TIMEOUT", 60))
+
+# The number of seconds that successful basic auth logins are cached for
+BASIC_AUTH_CACHE_TIMEOUT = int(os.environ.get("BASIC_AUTH_CACHE_TIMEOUT", 60))
+
 # Webhook event definition
 HOOK_EVENTS = {
     # 'any.event.name': 'App.Model.Action' (created/updated/deleted)
@@ -153,9 +167,61 @@ HOOK_EVENTS = {
 }
 
 HOOK_DELIVERER = "identities.tasks.deliver_hook_wrapper"
+HOOK_FINDER = "identities.models.find_and_fire_hook"
+
+# The number of seconds that each process caches the hooks subscribed to an
+# event for. Changes made in other processes take up to this long to apply.
+HOOK_CACHE_TIMEOUT = int(os.environ.get("HOOK_CACHE_TIMEOUT", 60))
 
 HOOK_AUTH_TOKEN = os.environ.get("HOOK_AUTH_TOKEN", "REPLACEME")
 
+# The number of hook deliveries queued per task when hooks are fired in bulk
+HOOK_BATCH_SIZE = int(os.environ.get("HOOK_BATCH_SIZE", 100))
+
+# Timeouts, in seconds, for webhook delivery requests
+HOOK_CONNECT_TIMEOUT = float(os.environ.get("HOOK_CONNECT_TIMEOUT", 5))
+HOOK_READ_TIMEOUT = float(os.environ.get("HOOK_READ_TIMEOUT", 30))
+# The number of hosts to keep connection pools for, and the number of open
+# connections kept in each pool, in each worker process
+HOOK_POOL_CONNECTIONS = int(os.environ.get("HOOK_POOL_CONNECTIONS", 10))
+HOOK_POOL_MAXSIZE = int(os.environ.get("HOOK_POOL_MAXSIZE", 10))
+
+# If set, webhook deliveries are written to an outbox table in the same
+# transaction as the change that fired them, and queued every
+# HOOK_OUTBOX_DISPATCH_INTERVAL seconds by the dispatch_outbox task
+HOOK_OUTBOX = os.environ.get("HOOK_OUTBOX", "false").lower() == "true"
+HOOK_OUTBOX_DISPATCH_INTERVAL = float(
+    os.environ.get("HOOK_OUTBOX_DISPATCH_INTERVAL", 1)
+)
+# The number of deliveries in flight at once, in total and to each target, for
+# the dispatch_hooks command
+HOOK_DISPATCHER_CONCURRENCY = int(os.environ.get("HOOK_DISPATCHER_CONCURRENCY", 1000))
+HOOK_DISPATCHER_TARGET_CONCURRENCY = int(
+    os.environ.get("HOOK_DISPATCHER_TARGET_CONCURRENCY", 100)
+)
+# The number of seconds that deliveries claimed by the dispatch_hooks command
+# are leased to it for, after which another dispatcher can claim them
+HOOK_DISPATCHER_LEASE_TIMEOUT = int(
+    os.environ.get("HOOK_DISPATCHER_LEASE_TIMEOUT", 300)
+)
+# If set, the dispatch_hooks command delivers the outbox, and the
+# dispatch_outbox task only queues deliveries that have been waiting for longer
+# than HOOK_DISPATCHER_LEASE_TIMEOUT, in case no dispatcher is running
+HOOK_DISPATCHER = os.environ.get("HOOK_DISPATCHER", "false").lower() == "true"
+
+# Failed webhook deliveries are retried up to HOOK_MAX_RETRIES times, waiting
+# HOOK_RETRY_BACKOFF seconds, doubling up to HOOK_RETRY_BACKOFF_MAX seconds,
+# between attempts
+HOOK_MAX_RETRIES = int(os.environ.get("HOOK_MAX_RETRIES", 5))
+HOOK_RETRY_BACKOFF = int(os.environ.get("HOOK_RETRY_BACKOFF", 10))
+HOOK_RETRY_BACKOFF_MAX = int(os.environ.get("HOOK_RETRY_BACKOFF_MAX", 600))
+# Deliveries to a target are paused for HOOK_CIRCUIT_RESET_TIMEOUT seconds
+# after HOOK_CIRCUIT_FAILURE_THRESHOLD consecutive failures
+HOOK_CIRCUIT_FAILURE_THRESHOLD = int(
+    os.environ.get("HOOK_CIRCUIT_FAILURE_THRESHOLD", 5)
+)
+HOOK_CIRCUIT_RESET_TIMEOUT = int(os.environ.get("HOOK_CIRCUIT_RESET_TIMEOUT", 60))
+
 # Celery configuration options
 CELERY_BROKER_URL = os.environ.get("BROKER_URL", "redis://localhost:6379/0")
 
@@ -177,11 +243,27 @@ CELERY_TASK_CREATE_MISSING_QUEUES = True
 CELERY_TASK_ROUTES = {
     "celery.backend_cleanup": {"queue": "mediumpriority"},
     "identities.tasks.DeliverHook": {"queue": "priority"},
+    "identities.tasks.DeliverHooks": {"queue": "priority"},
     "identities.tasks.populate_detail_key": {"queue": "priority"},
+    "seed_identity_store.identities.tasks.flush_failed_message_counts": {
+        "queue": "priority"
+    },
+    "seed_identity_store.identities.tasks.dispatch_outbox": {"queue": "priority"},
+    "seed_identity_store.identities.tasks.deliver_hook_batch": {"queue": "priority"},
+    "seed_identity_store.identities.tasks.reconcile_detail_keys": {
+        "queue": "mediumpriority"
+    },
 }
 
 ADDRESS_TYPES = ["msisdn", "email"]
 
+CELERY_BEAT_SCHEDULE = {}
+if HOOK_OUTBOX:
+    CELERY_BEAT_SCHEDULE["dispatch-outbox"] = {
+        "task": "seed_identity_store.identities.tasks.dispatch_outbox",
+        "schedule": HOOK_OUTBOX_DISPATCH_INTERVAL,
+    }
+
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_ACCEPT_CONTENT = ["json"]
@@ -201,9 +283,49 @@ if PAPERTRAIL:
     )
 
 
-MAX_CONSECUTIVE_SEND_FAILURES = os.environ.get("MAX_CONSECUTIVE_SEND_FAILURES", 5)
+MAX_CONSECUTIVE_SEND_FAILURES = int(os.environ.get("MAX_CONSECUTIVE_SEND_FAILURES", 5))
+# If set, the identity.max_failures hook is fired again every this many failures
+# after MAX_CONSECUTIVE_SEND_FAILURES is reached, instead of only once
+MAX_FAILURES_RENOTIFY_INTERVAL = int(
+    os.environ.get("MAX_FAILURES_RENOTIFY_INTERVAL", 0)
+)
+
+# If set, delivery reports are buffered in the default cache and written to the
+# database every this many seconds, instead of on every request
+FAILED_MESSAGE_COUNT_FLUSH_INTERVAL = int(
+    os.environ.get("FAILED_MESSAGE_COUNT_FLUSH_INTERVAL", 0)
+)
+if FAILED_MESSAGE_COUNT_FLUSH_INTERVAL:
+    CELERY_BEAT_SCHEDULE["flush-failed-message-counts"] = {
+        "task": "seed_identity_store.identities.tasks.flush_failed_message_counts",
+        "schedule": FAILED_MESSAGE_COUNT_FLUSH_INTERVAL,
+    }
+
+# How many levels of nested keys in identity details are recorded as detail
+# keys, e.g. 2 records "addresses" and "addresses.msisdn"
+DETAIL_KEY_DEPTH = int(os.environ.get("DETAIL_KEY_DEPTH", 2))
+# The number of seconds between recounts of the identities with each detail key,
+# and the number of identities counted in each query
+DETAIL_KEY_RECONCILE_INTERVAL = int(
+    os.environ.get("DETAIL_KEY_RECONCILE_INTERVAL", 86400)
+)
+DETAIL_KEY_RECONCILE_BATCH_SIZE = int(
+    os.environ.get("DETAIL_KEY_RECONCILE_BATCH_SIZE", 10000)
+)
+if DETAIL_KEY_RECONCILE_INTERVAL:
+    CELERY_BEAT_SCHEDULE["reconcile-detail-keys"] = {
+        "task": "seed_identity_store.identities.tasks.reconcile_detail_keys",
+        "schedule": DETAIL_KEY_RECONCILE_INTERVAL,
+    }
+
+# The maximum number of items accepted by the bulk endpoints in one request
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 1000))
 
 CACHES = {
     "default": env.cache(default="locmemcache://"),
-    "locmem": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    # Kept separate from a locmem default cache
+    "locmem": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "locmem",
+    },
 }
@@ -0,0 +1,29 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from prometheus_client import REGISTRY
+
+from seed_identity_store.metrics import start_metrics_server
+
+
+@patch("seed_identity_store.metrics.start_http_server")
+class StartMetricsServerTests(TestCase):
+    def test_disabled(self, start_http_server):
+        start_metrics_server()
+        start_http_server.assert_not_called()
+
+    @override_settings(METRICS_PORT=9100)
+    def test_single_process(self, start_http_server):
+        start_metrics_server()
+        start_http_server.assert_called_once_with(9100, registry=REGISTRY)
+
+    @override_settings(METRICS_PORT=9100)
+    def test_multiprocess(self, start_http_server):
+        with tempfile.TemporaryDirectory() as path:
+            with patch.dict(os.environ, {"prometheus_multiproc_dir": path}):
+                start_metrics_server()
+        [(args, kwargs)] = start_http_server.call_args_list
+        self.assertEqual(args, (9100,))
+        self.assertIsNot(kwargs["registry"], REGISTRY)
@@ -48,6 +48,7 @@ setup(
         "seed-services-client>=0.31.0",
         "seed-papertrail>=1.5.1",
         "django-prometheus==1.0.15",
+        "aiohttp==3.6.2",
     ],
     classifiers=[
         "Development Status :: 4 - Beta",